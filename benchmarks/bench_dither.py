@@ -0,0 +1,42 @@
+"""
+Micro-benchmark: per-mode dithering cost at panel resolution.
+
+Run from the repository root:
+
+    python benchmarks/bench_dither.py [-n ROUNDS]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageFilter
+import dithering
+
+CANVAS_SIZE = (250, 122)
+
+
+def synthetic_photo(size=CANVAS_SIZE):
+    """A smooth gradient with soft noise, close enough to a downscaled photo."""
+    gradient = Image.linear_gradient('L').resize(size)
+    noise = Image.effect_noise(size, 40).filter(ImageFilter.GaussianBlur(2))
+    return Image.blend(gradient, noise, 0.3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time each dithering mode.")
+    parser.add_argument('-n', '--rounds', type=int, default=20, help='Timed rounds per mode')
+    args = parser.parse_args()
+
+    image = synthetic_photo()
+    print(f"{'mode':<18}{'ms':>10}")
+    for name in dithering.MODES:
+        dithering.dither(image, name)  # warm caches (e.g. the Bayer tile)
+        best = min(timeit.repeat(lambda: dithering.dither(image, name), number=1, repeat=args.rounds))
+        print(f"{name:<18}{best * 1e3:>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Micro-benchmark: framebuffer packing vs. the original per-pixel loop.
+
+Run from the repository root:
+
+    python benchmarks/bench_getbuffer.py [-n ROUNDS]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+from lib import framebuffer
+
+EPD_WIDTH = 122
+EPD_HEIGHT = 250
+
+
+def legacy_getbuffer(image, width=EPD_WIDTH, height=EPD_HEIGHT):
+    """The nested-loop EPD.getbuffer this repo shipped with, kept as a baseline."""
+    if width % 8 == 0:
+        linewidth = int(width / 8)
+    else:
+        linewidth = int(width / 8) + 1
+
+    buf = [0xFF] * (linewidth * height)
+    image_monocolor = image.convert('1')
+    imwidth, imheight = image_monocolor.size
+    pixels = image_monocolor.load()
+
+    if imwidth == width and imheight == height:
+        for y in range(imheight):
+            for x in range(imwidth):
+                if pixels[x, y] == 0:
+                    x = imwidth - x
+                    buf[int(x / 8) + y * linewidth] &= ~(0x80 >> (x % 8))
+    elif imwidth == height and imheight == width:
+        for y in range(imheight):
+            for x in range(imwidth):
+                newx = y
+                newy = height - x - 1
+                if pixels[x, y] == 0:
+                    newy = imwidth - newy - 1
+                    buf[int(newx / 8) + newy * linewidth] &= ~(0x80 >> (y % 8))
+    return buf
+
+
+def legacy_invert(image, width=EPD_WIDTH, height=EPD_HEIGHT):
+    """The nested-loop inversion from the original EPD.displayPartial."""
+    linewidth = (width + 7) // 8
+    buf = [0x00] * height * linewidth
+    for j in range(0, height):
+        for i in range(0, linewidth):
+            buf[i + j * linewidth] = ~image[i + j * linewidth] & 0xFF
+    return buf
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare framebuffer packing implementations.")
+    parser.add_argument('-n', '--rounds', type=int, default=20, help='Timed rounds per case')
+    args = parser.parse_args()
+
+    cases = {
+        'vertical': Image.effect_noise((EPD_WIDTH, EPD_HEIGHT), 64).convert('1'),
+        'horizontal': Image.effect_noise((EPD_HEIGHT, EPD_WIDTH), 64).convert('1'),
+    }
+
+    print(f"{'case':<12}{'legacy ms':>12}{'packed ms':>12}{'speedup':>10}")
+    for name, image in cases.items():
+        expected = bytes(legacy_getbuffer(image))
+        actual = framebuffer.pack(image, EPD_WIDTH, EPD_HEIGHT)
+        if actual != expected:
+            sys.exit(f"{name}: packed buffer differs from the legacy loop")
+
+        legacy = min(timeit.repeat(lambda: legacy_getbuffer(image), number=1, repeat=args.rounds))
+        packed = min(timeit.repeat(lambda: framebuffer.pack(image, EPD_WIDTH, EPD_HEIGHT), number=1, repeat=args.rounds))
+        print(f"{name:<12}{legacy * 1e3:>12.3f}{packed * 1e3:>12.3f}{legacy / packed:>9.0f}x")
+
+    frame = framebuffer.pack(cases['horizontal'], EPD_WIDTH, EPD_HEIGHT)
+    if bytes(legacy_invert(frame)) != framebuffer.invert(frame):
+        sys.exit("invert: differs from the legacy loop")
+    legacy = min(timeit.repeat(lambda: legacy_invert(frame), number=1, repeat=args.rounds))
+    packed = min(timeit.repeat(lambda: framebuffer.invert(frame), number=1, repeat=args.rounds))
+    print(f"{'invert':<12}{legacy * 1e3:>12.3f}{packed * 1e3:>12.3f}{legacy / packed:>9.0f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+"""
+End-to-end benchmark suite: render pipeline, panel transfer, playback and ingest.
+
+Runs on plain Linux against the simulated panel (EPD_BACKEND=virtual) and a
+synthetic photo corpus.  Run from the repository root:
+
+    python benchmarks/suite.py [--sizes 10,1000,10000] [--samples 30] [--output results.json]
+
+Every stage reports p50/p95 in milliseconds; the JSON output also records
+peak RSS and the git commit so runs can be compared across commits.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+os.chdir(REPO_DIR)  # display_driver reads config.yaml from the working directory
+
+# Simulated panel with instant BUSY/SPI so transfer times are pure CPU cost;
+# the modelled panel time is reported separately from epdconfig.stats.
+os.environ['EPD_BACKEND'] = 'virtual'
+os.environ.setdefault('EPD_VIRTUAL_TIME_SCALE', '0')
+
+from PIL import Image, ImageFilter
+import db
+import display_driver
+import dithering
+import render
+import transcode
+from frame_store import FrameStore
+from image_store import CHUNK_SIZE, ImageStore
+from lib import epd2in13_V2, epdconfig, framebuffer
+
+logging.getLogger().setLevel(logging.WARNING)
+
+# Distinct source photos; larger corpora link to these so 10k photos do not
+# need 10k x 3 MB of disk.
+POOL_SIZE = 8
+
+
+def synthetic_photo(size, seed):
+    """A camera-sized JPEG-like image: gradient, blurred noise and shapes."""
+    rng = random.Random(seed)
+    small = (size[0] // 8, size[1] // 8)
+    gradient = Image.linear_gradient('L').resize(small).rotate(rng.randint(0, 359))
+    noise = Image.effect_noise(small, rng.randint(20, 80)).filter(ImageFilter.GaussianBlur(3))
+    base = Image.blend(gradient, noise, 0.4).resize(size, Image.BILINEAR)
+    # Fine detail so the JPEG is as heavy as a real photo
+    detail = Image.effect_noise(size, 24)
+    return Image.merge('RGB', (base, Image.blend(base, detail, 0.3), detail))
+
+
+def save_pool_photo(path, resolution, seed):
+    image = synthetic_photo(resolution, seed)
+    exif = Image.Exif()
+    # Mix of landscape and rotated-portrait originals, like a phone roll
+    exif[0x0112] = 6 if seed % 3 == 0 else 1
+    image.save(path, quality=90, exif=exif)
+    return path
+
+
+def build_pool(folder, resolution):
+    # Generated in a child process so the full-size RGB buffers do not
+    # count towards this process's peak RSS
+    paths = [os.path.join(folder, f"pool_{i}.jpg") for i in range(POOL_SIZE)]
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return list(executor.map(save_pool_photo, paths, [resolution] * POOL_SIZE, range(POOL_SIZE)))
+
+
+def build_corpus(folder, pool, count):
+    """Hard-link `count` photo paths onto the pool (falls back to copies)."""
+    paths = []
+    for i in range(count):
+        path = os.path.join(folder, f"IMG_{i:05d}.jpg")
+        try:
+            os.link(pool[i % len(pool)], path)
+        except OSError:
+            shutil.copyfile(pool[i % len(pool)], path)
+        paths.append(path)
+    return paths
+
+
+def timed(samples, func, *args):
+    """Run func(*args) once per sample argument list and return durations in ms."""
+    durations = []
+    for sample in samples:
+        start = time.perf_counter()
+        func(*args, *sample)
+        durations.append((time.perf_counter() - start) * 1000)
+    return durations
+
+
+def summarize(durations):
+    ordered = sorted(durations)
+    p95_index = min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))
+    return {
+        'n': len(ordered),
+        'p50_ms': round(statistics.median(ordered), 3),
+        'p95_ms': round(ordered[p95_index], 3),
+        'mean_ms': round(statistics.fmean(ordered), 3),
+    }
+
+
+def peak_rss_kb():
+    # High-water mark for the whole run so far; ru_maxrss is KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def bench_render(paths, dither):
+    """decode -> resize -> dither -> pack, each stage timed on its own."""
+    stages = {'decode': [], 'resize': [], 'dither': [], 'pack': []}
+    frames = []
+    for path in paths:
+        with Image.open(path) as image:
+            start = time.perf_counter()
+            decoded = render.decode_image(image)
+            stages['decode'].append((time.perf_counter() - start) * 1000)
+
+            start = time.perf_counter()
+            fitted = render.fit_image(decoded)
+            stages['resize'].append((time.perf_counter() - start) * 1000)
+
+        canvas = render.center_on_canvas(fitted)
+        start = time.perf_counter()
+        dithered = dithering.dither(canvas, dither)
+        stages['dither'].append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        frames.append(framebuffer.pack(dithered, epd2in13_V2.EPD_WIDTH, epd2in13_V2.EPD_HEIGHT))
+        stages['pack'].append((time.perf_counter() - start) * 1000)
+    return stages, frames
+
+
+def bench_transfer(frames):
+    """Push frames through the driver into the simulated controller."""
+    epd = epd2in13_V2.EPD()
+    epd.init(epd.FULL_UPDATE)
+    before = dict(epdconfig.stats)
+    durations = timed([(frame,) for frame in frames], epd.display)
+    modelled_ms = epdconfig.stats['busy_ms'] - before['busy_ms']
+    spi_bytes = epdconfig.stats['spi_bytes'] - before['spi_bytes']
+    return durations, {
+        'modelled_busy_ms_per_frame': round(modelled_ms / len(frames), 1),
+        'modelled_spi_ms_per_frame': round(spi_bytes * 8 / epdconfig.SPI_SPEED_HZ * 1000 / len(frames), 1),
+    }
+
+
+def bench_next_image(db_name, count, samples):
+    """Time fetch_next_image against a library of `count` rows."""
+    display_driver.DB_NAME = db_name
+    results = {}
+    for mode in ('sequential', 'random'):
+        display_driver.PLAYBACK_MODE = mode
+        results[mode] = timed([()] * samples, display_driver.fetch_next_image)
+    return results
+
+
+def bench_ingest(workdir, conn, paths, dither):
+    """Per-item ingest: file into the image folder, DB row, pre-rendered frame."""
+    image_store = ImageStore(os.path.join(workdir, 'images'))
+    frames = FrameStore(os.path.join(workdir, 'frames.bin'))
+
+    durations = []
+    for i, path in enumerate(paths):
+        start = time.perf_counter()
+        media_id = f"ingest-{i}"
+        db.known_media_ids(conn, [media_id])
+        with open(path, 'rb') as f:  # stands in for the download
+            content_hash, file_path = image_store.write(iter(lambda: f.read(CHUNK_SIZE), b''))
+        with db.transaction(conn) as cursor:
+            added = db.add_images(cursor, [(media_id, file_path, content_hash)])
+        frames.put(added[media_id], render.render_frame(file_path, dither))
+        durations.append((time.perf_counter() - start) * 1000)
+    frames.close()
+    return durations
+
+
+def bench_transcode(paths, dither):
+    """Ingest transcoding throughput in images/sec: one worker vs. one per core."""
+    throughput = {}
+    for workers in sorted({1, transcode.default_workers()}):
+        with transcode.pool(workers) as executor:
+            # Warm the workers up so process start-up is not counted
+            list(executor.map(transcode.transcode, paths[:workers], [dither] * workers))
+            start = time.perf_counter()
+            for _, _, error in transcode.transcode_all(executor, workers, ((p, p, None) for p in paths), dither):
+                if error is not None:
+                    raise error
+            elapsed = time.perf_counter() - start
+        throughput[f"workers_{workers}"] = round(len(paths) / elapsed, 2)
+    return throughput
+
+
+def run_corpus(workdir, pool, count, samples, dither):
+    corpus_dir = os.path.join(workdir, f"corpus_{count}")
+    os.makedirs(corpus_dir)
+    paths = build_corpus(corpus_dir, pool, count)
+    sample_paths = paths[:samples]
+
+    db_name = os.path.join(corpus_dir, 'photos.db')
+    db.init_db(db_name)
+    conn = db.connect(db_name)
+    with db.transaction(conn) as cursor:
+        db.add_images(cursor, [(f"corpus-{i}", path, None) for i, path in enumerate(paths)])
+
+    result = {'photos': count, 'stages': {}}
+    stages, frames = bench_render(sample_paths, dither)
+    for name, durations in stages.items():
+        result['stages'][name] = summarize(durations)
+
+    durations, modelled = bench_transfer(frames)
+    result['stages']['transfer'] = summarize(durations)
+    result['stages']['transfer'].update(modelled)
+
+    for mode, durations in bench_next_image(db_name, count, max(samples, 100)).items():
+        result['stages'][f"db_next_{mode}"] = summarize(durations)
+
+    result['stages']['ingest'] = summarize(bench_ingest(corpus_dir, conn, sample_paths, dither))
+    result['transcode_images_per_sec'] = bench_transcode(sample_paths, dither)
+    db.close(db_name)
+
+    result['peak_rss_kb'] = peak_rss_kb()
+    shutil.rmtree(corpus_dir)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_table(results):
+    for result in results:
+        print(f"\n{result['photos']} photos (peak RSS {result['peak_rss_kb'] / 1024:.1f} MiB)")
+        print(f"  {'stage':<22}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}")
+        for name, stats in result['stages'].items():
+            print(f"  {name:<22}{stats['n']:>6}{stats['p50_ms']:>10.3f}{stats['p95_ms']:>10.3f}")
+        for name, rate in result['transcode_images_per_sec'].items():
+            print(f"  transcode {name:<12}{rate:>16.2f} images/sec")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the SnapInk benchmark suite.")
+    parser.add_argument('--sizes', default='10,1000,10000', help='Comma-separated corpus sizes')
+    parser.add_argument('--samples', type=int, default=30, help='Photos timed per per-image stage')
+    parser.add_argument('--resolution', default='4032x3024', help='Synthetic photo resolution, WxH')
+    parser.add_argument('--dither', choices=list(dithering.MODES), default=display_driver.DITHER)
+    parser.add_argument('--output', help='Write machine-readable results to this JSON file')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    resolution = tuple(int(v) for v in args.resolution.lower().split('x'))
+
+    workdir = tempfile.mkdtemp(prefix='snapink-bench-')
+    try:
+        print(f"Generating {POOL_SIZE} synthetic {resolution[0]}x{resolution[1]} photos...")
+        pool = build_pool(workdir, resolution)
+        results = [run_corpus(workdir, pool, size, min(args.samples, size), args.dither) for size in sizes]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_table(results)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'resolution': list(resolution),
+        'dither': args.dither,
+        'peak_rss_kb': peak_rss_kb(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,436 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# How long a writer waits for another process's transaction before giving up
+BUSY_TIMEOUT_MS = 5000
+# Every query here is a constant string, so the per-connection statement
+# cache keeps them all prepared
+CACHED_STATEMENTS = 64
+
+# Uniform float in [0, 1) from SQLite's 64-bit random(); 53 bits like a double
+RANDOM_UNIT = "(((random() >> 11) & 9007199254740991) / 9007199254740992.0)"
+
+
+def _add_column(cursor, table, column, declaration):
+    """
+    Add a column to a table created by an older version, if it is missing.
+    """
+    columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+
+_local = threading.local()
+# Every open connection, from every thread, so close_all() can reach them
+_open = {}
+_open_lock = threading.Lock()
+
+
+def connect(db_name):
+    """
+    Return this thread's connection to db_name, opening it on first use.
+
+    Connections stay open for the life of the thread and run in WAL mode,
+    so the display loop keeps reading and advancing playback while the
+    ingest server writes.  They are in autocommit mode; group writes with
+    transaction().
+    """
+    connections = _local.__dict__.setdefault('connections', {})
+    conn = connections.get(db_name)
+    if conn is not None:
+        with _open_lock:
+            if conn not in _open.get(db_name, ()):
+                conn = None  # closed by close_all()
+    if conn is None:
+        # Only ever used by this thread; check_same_thread is off so that
+        # close_all() can close it from another one
+        conn = sqlite3.connect(
+            db_name,
+            timeout=BUSY_TIMEOUT_MS / 1000,
+            isolation_level=None,
+            cached_statements=CACHED_STATEMENTS,
+            check_same_thread=False,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Durable at checkpoints rather than every commit; WAL never corrupts
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        connections[db_name] = conn
+        with _open_lock:
+            _open.setdefault(db_name, set()).add(conn)
+    return conn
+
+
+def close(db_name):
+    """
+    Close this thread's connection to db_name, if it has one.
+    """
+    conn = _local.__dict__.get('connections', {}).pop(db_name, None)
+    if conn is not None:
+        with _open_lock:
+            _open.get(db_name, set()).discard(conn)
+        conn.close()
+
+
+def close_all(db_name):
+    """
+    Close every thread's connection to db_name, e.g. before deleting it.
+    Stop the threads using them first; a thread that connects again later
+    gets a fresh connection.
+    """
+    with _open_lock:
+        connections = _open.pop(db_name, set())
+    for conn in connections:
+        conn.close()
+
+
+@contextmanager
+def transaction(conn):
+    """
+    Short write transaction: takes the write lock up front and yields a
+    cursor; commits on success and rolls back on error.
+    """
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        yield cursor
+    except BaseException:
+        cursor.execute("ROLLBACK")
+        raise
+    cursor.execute("COMMIT")
+
+
+def init_db(db_name):
+    """
+    Create the tables and indexes if they do not exist yet.
+    """
+    with transaction(connect(db_name)) as cursor:
+        _create_schema(cursor)
+
+
+def _create_schema(cursor):
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS images (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        path TEXT,
+                        sequence INTEGER,
+                        shuffle_rank REAL,
+                        media_id TEXT,
+                        content_hash TEXT,
+                        width INTEGER,
+                        height INTEGER,
+                        taken TEXT,
+                        preview TEXT)"""
+    )
+    _add_column(cursor, 'images', 'shuffle_rank', 'REAL')
+    _add_column(cursor, 'images', 'media_id', 'TEXT')
+    _add_column(cursor, 'images', 'content_hash', 'TEXT')
+    for column in ('width INTEGER', 'height INTEGER', 'taken TEXT', 'preview TEXT'):
+        _add_column(cursor, 'images', *column.split())
+    # Picker media item ids make ingest idempotent; rows from before media
+    # ids were stored keep NULL, which UNIQUE allows any number of
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_images_media ON images (media_id)")
+    # sha256 of the original; the same bytes picked twice share file and frame
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_hash ON images (content_hash)")
+    # (sequence, id) gives a total playback order even if sequences repeat;
+    # the rowid is part of every index, so next-image is one index seek.
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_sequence ON images (sequence, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_path ON images (path)")
+    # Random playback walks a shuffled order stored as one rank per image
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_images_shuffle ON images (shuffle_rank, id)")
+
+    # Single-row playback cursor instead of a last_shown flag per image.
+    # `generation` is bumped whenever the library changes; random playback
+    # compares it with `shuffle_generation` to deal new images into the bag.
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS playback (
+                        id INTEGER PRIMARY KEY CHECK (id = 1),
+                        sequence INTEGER,
+                        image_id INTEGER,
+                        generation INTEGER NOT NULL DEFAULT 0,
+                        shuffle_rank REAL,
+                        shuffle_image_id INTEGER,
+                        shuffle_generation INTEGER)"""
+    )
+    for column in ('shuffle_rank REAL', 'shuffle_image_id INTEGER', 'shuffle_generation INTEGER'):
+        _add_column(cursor, 'playback', *column.split())
+    cursor.execute("INSERT OR IGNORE INTO playback (id) VALUES (1)")
+
+    # Background ingest jobs; counters are progress so far
+    cursor.execute(
+        """CREATE TABLE IF NOT EXISTS jobs (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        session_id TEXT NOT NULL,
+                        state TEXT NOT NULL DEFAULT 'queued',
+                        listed INTEGER NOT NULL DEFAULT 0,
+                        downloaded INTEGER NOT NULL DEFAULT 0,
+                        rendered INTEGER NOT NULL DEFAULT 0,
+                        failed INTEGER NOT NULL DEFAULT 0,
+                        bytes INTEGER NOT NULL DEFAULT 0,
+                        error TEXT,
+                        created REAL,
+                        started REAL,
+                        finished REAL)"""
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_session ON jobs (session_id)")
+
+
+def bump_generation(cursor):
+    """
+    Mark the library as changed; call inside the transaction that changed it.
+    """
+    cursor.execute("UPDATE playback SET generation = generation + 1 WHERE id = 1")
+
+
+def known_media_ids(conn, media_ids, chunk_size=500):
+    """
+    Return the subset of media_ids that are already in the library.
+    """
+    media_ids = list(media_ids)
+    known = set()
+    for start in range(0, len(media_ids), chunk_size):
+        chunk = media_ids[start:start + chunk_size]
+        placeholders = ",".join("?" * len(chunk))
+        rows = conn.execute(f"SELECT media_id FROM images WHERE media_id IN ({placeholders})", chunk)
+        known.update(row[0] for row in rows)
+    return known
+
+
+def add_images(cursor, images):
+    """
+    Append (media_id, path, content_hash) rows to the end of the playback
+    order, skipping media ids already in the library. Call inside a
+    transaction; returns {media_id: id} for the rows actually inserted.
+    """
+    cursor.execute("SELECT COALESCE(MAX(sequence), -1) + 1 FROM images")
+    first_sequence = cursor.fetchone()[0]
+    cursor.executemany(
+        "INSERT OR IGNORE INTO images (media_id, path, content_hash, sequence) VALUES (?, ?, ?, ?)",
+        [(media_id, path, content_hash, first_sequence + i)
+         for i, (media_id, path, content_hash) in enumerate(images)],
+    )
+    if cursor.rowcount <= 0:
+        return {}
+
+    bump_generation(cursor)
+    # Sequences only grow, so the new rows are exactly those from first_sequence on
+    cursor.execute("SELECT media_id, id FROM images WHERE sequence >= ?", (first_sequence,))
+    return dict(cursor.fetchall())
+
+
+IMAGE_METADATA = ('width', 'height', 'taken', 'preview')
+
+
+def images_with_hash(conn, content_hash):
+    """
+    (id, metadata dict) of every image whose original has this sha256,
+    oldest first.
+    """
+    rows = conn.execute(
+        "SELECT id, width, height, taken, preview FROM images WHERE content_hash = ? ORDER BY id",
+        (content_hash,),
+    )
+    return [(row[0], dict(zip(IMAGE_METADATA, row[1:]))) for row in rows]
+
+
+def set_image_metadata(cursor, images):
+    """
+    Store what ingest learned about each image, from (id, metadata dict)
+    pairs with the IMAGE_METADATA keys.
+    """
+    cursor.executemany(
+        "UPDATE images SET width = ?, height = ?, taken = ?, preview = ? WHERE id = ?",
+        [[metadata.get(name) for name in IMAGE_METADATA] + [image_id] for image_id, metadata in images],
+    )
+
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_COUNTERS = ('listed', 'downloaded', 'rendered', 'failed', 'bytes')
+
+
+def add_job(cursor, session_id):
+    """
+    Queue an ingest of a Picker session; returns the job id.
+    """
+    cursor.execute(
+        "INSERT INTO jobs (session_id, state, created) VALUES (?, ?, ?)",
+        (session_id, JOB_QUEUED, time.time()),
+    )
+    return cursor.lastrowid
+
+
+def find_job(conn, session_id):
+    """
+    Id of the job importing a Picker session, or None. Failed jobs are
+    ignored, so the session can be queued again (e.g. a confirm that came
+    before the user finished picking).
+    """
+    row = conn.execute(
+        "SELECT id FROM jobs WHERE session_id = ? AND state != ? ORDER BY id LIMIT 1",
+        (session_id, JOB_FAILED),
+    ).fetchone()
+    return row[0] if row else None
+
+
+def claim_job(cursor):
+    """
+    Mark the oldest unfinished job as running and return (id, session_id).
+    A job left running by a previous process is claimed again and starts
+    over; ingest is idempotent, so finished items are skipped.
+    """
+    cursor.execute(
+        "SELECT id, session_id FROM jobs WHERE state IN (?, ?) ORDER BY id LIMIT 1",
+        (JOB_QUEUED, JOB_RUNNING),
+    )
+    job = cursor.fetchone()
+    if job is None:
+        return None
+    cursor.execute(
+        """UPDATE jobs SET state = ?, started = ?, listed = 0, downloaded = 0,
+                           rendered = 0, failed = 0, bytes = 0 WHERE id = ?""",
+        (JOB_RUNNING, time.time(), job[0]),
+    )
+    return job
+
+
+def update_job(cursor, job_id, **counters):
+    """
+    Set progress counters (listed, downloaded, rendered, failed, bytes).
+    """
+    columns = [name for name in JOB_COUNTERS if name in counters]
+    assignments = ", ".join(f"{name} = ?" for name in columns)
+    cursor.execute(
+        f"UPDATE jobs SET {assignments} WHERE id = ?", [counters[name] for name in columns] + [job_id]
+    )
+
+
+def finish_job(cursor, job_id, error=None):
+    cursor.execute(
+        "UPDATE jobs SET state = ?, error = ?, finished = ? WHERE id = ?",
+        (JOB_FAILED if error else JOB_DONE, error, time.time(), job_id),
+    )
+
+
+def get_job(conn, job_id):
+    """
+    Job status as a dict, with the download rate in bytes per second and
+    the processing rate in images per second; None for an unknown id.
+    """
+    cursor = conn.execute(
+        """SELECT id, state, listed, downloaded, rendered, failed, bytes, error,
+                  created, started, finished FROM jobs WHERE id = ?""",
+        (job_id,),
+    )
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    job = dict(zip([column[0] for column in cursor.description], row))
+    elapsed = (job['finished'] or time.time()) - job['started'] if job['started'] else 0
+    job['bytes_per_sec'] = round(job['bytes'] / elapsed) if elapsed > 0 else 0
+    job['images_per_sec'] = round(job['rendered'] / elapsed, 2) if elapsed > 0 else 0
+    return job
+
+
+def next_sequential(cursor):
+    """
+    Advance the playback cursor to the next image in sequence order, wrapping
+    around at the end. Returns (id, path) or None for an empty library.
+    """
+    cursor.execute("SELECT sequence, image_id FROM playback WHERE id = 1")
+    position = cursor.fetchone()
+
+    image = None
+    if position and position[0] is not None:
+        # Two index seeks rather than a row-value comparison, which SQLite
+        # only bounds on the leading column
+        cursor.execute(
+            "SELECT id, path, sequence FROM images WHERE sequence = ? AND id > ? ORDER BY id LIMIT 1",
+            position,
+        )
+        image = cursor.fetchone()
+        if image is None:
+            cursor.execute(
+                "SELECT id, path, sequence FROM images WHERE sequence > ? ORDER BY sequence, id LIMIT 1",
+                (position[0],),
+            )
+            image = cursor.fetchone()
+    if image is None:
+        # Start of the playlist, or wrap around after the last image
+        cursor.execute("SELECT id, path, sequence FROM images ORDER BY sequence, id LIMIT 1")
+        image = cursor.fetchone()
+    if image is None:
+        return None
+
+    cursor.execute(
+        "UPDATE playback SET sequence = ?, image_id = ? WHERE id = 1", (image[2], image[0])
+    )
+    return image[0], image[1]
+
+
+def _shuffle(cursor, last_image_id):
+    """
+    Start a new cycle: give every image a fresh random rank and return the
+    first (id, path, shuffle_rank), never the image that ended the last cycle.
+    """
+    cursor.execute(f"UPDATE images SET shuffle_rank = {RANDOM_UNIT}")
+    cursor.execute("SELECT id, path, shuffle_rank FROM images ORDER BY shuffle_rank, id LIMIT 2")
+    first = cursor.fetchall()
+    if len(first) == 2 and first[0][0] == last_image_id:
+        # Swap the first two so a cycle boundary never shows a photo twice in a row
+        (a_id, a_path, a_rank), (b_id, b_path, b_rank) = first
+        cursor.execute("UPDATE images SET shuffle_rank = ? WHERE id = ?", (b_rank, a_id))
+        cursor.execute("UPDATE images SET shuffle_rank = ? WHERE id = ?", (a_rank, b_id))
+        return b_id, b_path, a_rank
+    return first[0] if first else None
+
+
+def next_shuffled(cursor):
+    """
+    Advance the shuffle-bag cursor: every image is shown once, in random
+    order, before any image repeats. Returns (id, path) or None for an
+    empty library.
+
+    The permutation is a random rank per image, written once per cycle, so
+    each call is a single index seek however large the library is.
+    """
+    cursor.execute(
+        "SELECT shuffle_rank, shuffle_image_id, shuffle_generation, generation FROM playback WHERE id = 1"
+    )
+    rank, last_image_id, shuffle_generation, generation = cursor.fetchone()
+
+    image = None
+    if rank is not None:
+        if shuffle_generation != generation:
+            # Images added mid-cycle join the part of the bag not yet shown
+            cursor.execute(
+                f"UPDATE images SET shuffle_rank = ? + (1.0 - ?) * {RANDOM_UNIT} WHERE shuffle_rank IS NULL",
+                (rank, rank),
+            )
+        cursor.execute(
+            "SELECT id, path, shuffle_rank FROM images WHERE shuffle_rank = ? AND id > ? ORDER BY id LIMIT 1",
+            (rank, last_image_id),
+        )
+        image = cursor.fetchone()
+        if image is None:
+            cursor.execute(
+                "SELECT id, path, shuffle_rank FROM images WHERE shuffle_rank > ? ORDER BY shuffle_rank, id LIMIT 1",
+                (rank,),
+            )
+            image = cursor.fetchone()
+    if image is None:
+        # First run, or the bag is empty: reshuffle for the next cycle
+        image = _shuffle(cursor, last_image_id)
+    if image is None:
+        return None
+
+    cursor.execute(
+        "UPDATE playback SET shuffle_rank = ?, shuffle_image_id = ?, shuffle_generation = ? WHERE id = 1",
+        (image[2], image[0], generation),
+    )
+    return image[0], image[1]
@@ -1,10 +1,16 @@
 import os
 import time
 import logging
-import sqlite3
+import queue
+import sys
+import threading
 import yaml
-from lib import epd2in13_V2
-from PIL import Image
+import db
+from lib import epd2in13_V2, epdconfig
+from frame_store import FrameStore
+from panel import PanelSession
+from refresh import RefreshManager, SKIP
+from render import render_frame
 
 # Load Configuration
 CONFIG_FILE = 'config.yaml'
@@ -14,100 +20,176 @@ with open(CONFIG_FILE, 'r') as config_file:
 # Config Parameters
 DB_NAME = config['app']['db_name']
 IMAGE_FOLDER = config['app']['image_folder']
-REFRESH_RATE = config['display']['refresh_rate']
-PLAYBACK_MODE = config['display']['playback_mode']
+FRAME_STORE = config['app'].get('frame_store', 'frames.bin')
+DITHER = config['app'].get('dither', 'floyd-steinberg')
+REFRESH_RATE = config['app']['refresh_rate']
+PLAYBACK_MODE = config['app']['playback_mode']
+FULL_REFRESH_EVERY = config['app'].get('full_refresh_every', 10)
+PARTIAL_THRESHOLD = config['app'].get('partial_threshold', 0.15)
+PREFETCH_DEPTH = config['app'].get('prefetch_depth', 2)
+BUSY_TIMEOUT = config['app'].get('busy_timeout', 10)
+DEEP_SLEEP_AFTER = config['app'].get('deep_sleep_after', 60)
+SPI_SPEED_HZ = config['app'].get('spi_speed_hz', 4000000)
+EPD_BACKEND = config['app'].get('epd_backend', 'auto')
 
 # Logging Configuration
-logging.basicConfig(level=config['log_level'])
+logging.basicConfig(level=config['app']['log_level'])
+
+# The EPD_BACKEND environment variable takes precedence over the config
+if not os.environ.get('EPD_BACKEND'):
+    epdconfig.select_backend(EPD_BACKEND)
 
 def fetch_next_image():
     """
     Fetch the next image based on playback mode.
     """
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
+    # Each call is one short write transaction on this thread's connection
+    with db.transaction(db.connect(DB_NAME)) as cursor:
         if PLAYBACK_MODE == 'sequential':
-            # Get the last shown image
-            cursor.execute("SELECT id, path FROM images WHERE last_shown = 1 ORDER BY sequence LIMIT 1")
-            last_shown = cursor.fetchone()
-
-            # Select the next image in sequence
-            if last_shown:
-                cursor.execute("UPDATE images SET last_shown = 0 WHERE id = ?", (last_shown[0],))
-                cursor.execute(
-                    """
-                    SELECT id, path FROM images 
-                    WHERE sequence > (SELECT sequence FROM images WHERE id = ?) 
-                    ORDER BY sequence LIMIT 1
-                    """,
-                    (last_shown[0],)
-                )
-            else:
-                cursor.execute("SELECT id, path FROM images ORDER BY sequence LIMIT 1")
+            return db.next_sequential(cursor)
 
-        elif PLAYBACK_MODE == 'random':
-            # Random playback mode
-            cursor.execute("SELECT id, path FROM images ORDER BY RANDOM() LIMIT 1")
-        else:
-            logging.warning("Invalid playback mode. Defaulting to sequential.")
-            cursor.execute("SELECT id, path FROM images ORDER BY sequence LIMIT 1")
+        if PLAYBACK_MODE == 'random':
+            return db.next_shuffled(cursor)
 
-        image = cursor.fetchone()
-
-        # Update the last_shown flag
-        if image:
-            cursor.execute("UPDATE images SET last_shown = 1 WHERE id = ?", (image[0],))
-            return image[1]  # Return full path to the image
-        return None
+        logging.warning("Invalid playback mode. Defaulting to sequential.")
+        return db.next_sequential(cursor)
 
 
-def render_image(epd, image_path):
+def load_frame(frames, image_id, image_path):
     """
-    Render the given image on the e-paper display.
+    Return the packed panel buffer for an image, rendering it on a store miss.
     """
+    frame = frames.get(image_id)
+    if frame is not None:
+        return frame
+
     if not os.path.exists(image_path):
         logging.error(f"Image not found: {image_path}")
-        return
+        return None
+
+    # Not pre-rendered at ingest (older library or failed render): do it once now.
+    try:
+        frame = render_frame(image_path, DITHER)
+    except (OSError, ValueError) as e:
+        logging.error(f"Failed to render {image_path}: {e}")
+        return None
+    frames.put(image_id, frame)
+    return frame
+
+
+def open_panel():
+    """
+    EPD driver with the panel settings from config.yaml (SPI clock, BUSY
+    timeout); every entry point that drives the panel gets it from here.
+    """
+    epdconfig.set_spi_speed(SPI_SPEED_HZ)
+    epd = epd2in13_V2.EPD()
+    epd.busy_timeout_ms = BUSY_TIMEOUT * 1000
+    return epd
 
-    # Prepare the image for display
-    image = Image.open(image_path).convert('1')
-    image.thumbnail((epd.height, epd.width), Image.LANCZOS)
 
-    # Center the image on the display
-    canvas = Image.new('1', (epd.height, epd.width), 255)
-    x_offset = (epd.height - image.width) // 2
-    y_offset = (epd.width - image.height) // 2
-    canvas.paste(image, (x_offset, y_offset))
+def display_frame(epd, frame):
+    """
+    Push a single packed frame to the e-paper display and power it down.
+    """
+    panel = PanelSession(epd)
+    panel.wake(epd.FULL_UPDATE)
+    epd.display(frame)
+    panel.close()
+
+
+def prefetch_frames(frames, ready, stop):
+    """
+    Producer thread: prepare upcoming frames while the panel is busy.
+
+    Frames go into the bounded `ready` queue as (path, frame) pairs, so at
+    most PREFETCH_DEPTH frames are ever prepared ahead of the panel.  An
+    error is logged and the next image tried, so the thread never dies and
+    leaves the main loop waiting forever.
+    """
+    while not stop.is_set():
+        try:
+            prefetch_next(frames, ready, stop)
+        except Exception:
+            logging.exception("Failed to prepare the next frame")
+            stop.wait(REFRESH_RATE)
+
+
+def prefetch_next(frames, ready, stop):
+    """
+    Prepare the next image's frame and queue it for the panel.
+    """
+    image = fetch_next_image()
+    if not image:
+        logging.warning("No images available.")
+        stop.wait(REFRESH_RATE)
+        return
+
+    image_id, image_path = image
+    frame = load_frame(frames, image_id, image_path)
+    if frame is None:
+        # Missing or undecodable; don't spin through a broken library
+        stop.wait(REFRESH_RATE)
+        return
 
-    # Display the image
-    epd.init(epd.FULL_UPDATE)
-    epd.display(epd.getbuffer(canvas))
-    time.sleep(2)  # Hold the image for stability
-    epd.sleep()
-    logging.info(f"Image rendered: {image_path}")
+    while not stop.is_set():
+        try:
+            ready.put((image_path, frame), timeout=1)
+            return
+        except queue.Full:
+            pass
 
 
 def start_display_driver():
     """
     Main function to start the display driver.
     """
+    panel = None
+    stop = threading.Event()
     try:
         logging.info("Initializing E-Paper display driver...")
-        epd = epd2in13_V2.EPD()
+        db.init_db(DB_NAME)
+        epd = open_panel()
+        panel = PanelSession(epd, DEEP_SLEEP_AFTER)
+        frames = FrameStore(FRAME_STORE)
+        refresh = RefreshManager(panel, FULL_REFRESH_EVERY, PARTIAL_THRESHOLD)
+
+        ready = queue.Queue(maxsize=PREFETCH_DEPTH)
+        producer = threading.Thread(
+            target=prefetch_frames, args=(frames, ready, stop), name="prefetch", daemon=True
+        )
+        producer.start()
+
+        # Frames are due on a fixed monotonic schedule, independent of how
+        # long decoding or the refresh waveform took.
+        deadline = time.monotonic()
         while True:
-            image_path = fetch_next_image()
-            if image_path:
-                render_image(epd, image_path)
+            image_path, frame = ready.get()
+            if refresh.show(frame) != SKIP:
+                # Stays initialised between frames unless REFRESH_RATE is long
+                panel.idle(REFRESH_RATE)
+            logging.info(f"Image rendered: {image_path}")
+
+            deadline += REFRESH_RATE
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
             else:
-                logging.warning("No images available.")
-            time.sleep(REFRESH_RATE)
+                # Fell behind (e.g. no images for a while): restart the schedule
+                deadline = time.monotonic()
     except KeyboardInterrupt:
         logging.info("Display driver interrupted.")
     except Exception as e:
         logging.error(f"Unexpected error: {e}")
     finally:
         logging.info("Shutting down the display driver.")
+        stop.set()
+        if panel is not None:
+            panel.close()
 
 
 if __name__ == '__main__':
+    if '--import-time' in sys.argv:
+        from startup import import_time_report
+        sys.exit(import_time_report('display_driver'))
     start_display_driver()
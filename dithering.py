@@ -0,0 +1,124 @@
+from functools import lru_cache
+from PIL import Image, ImageChops
+
+# All modes take an `L` image at panel resolution and return a `1` image.
+THRESHOLD = 'threshold'
+BAYER = 'bayer'
+ATKINSON = 'atkinson'
+FLOYD_STEINBERG = 'floyd-steinberg'
+
+DEFAULT = FLOYD_STEINBERG
+
+
+def threshold(image):
+    """
+    Plain 50% threshold: fastest, but flattens midtones.
+    """
+    return image.convert('1', dither=Image.Dither.NONE)
+
+
+def _bayer_matrix(order):
+    matrix = [[0]]
+    while len(matrix) < order:
+        matrix = [
+            [4 * v for v in row] + [4 * v + 2 for v in row] for row in matrix
+        ] + [
+            [4 * v + 3 for v in row] + [4 * v + 1 for v in row] for row in matrix
+        ]
+    return matrix
+
+
+_NONZERO = [0] + [255] * 255
+
+
+@lru_cache(maxsize=4)
+def _bayer_tile(size, order=8):
+    """
+    Threshold map covering `size`, with levels spread over 0..255.
+    """
+    matrix = _bayer_matrix(order)
+    levels = order * order
+    cell = Image.new('L', (order, order))
+    cell.putdata([(v * 256 + 128) // levels for row in matrix for v in row])
+
+    tile = Image.new('L', size)
+    for y in range(0, size[1], order):
+        for x in range(0, size[0], order):
+            tile.paste(cell, (x, y))
+    return tile
+
+
+def bayer(image):
+    """
+    Ordered 8x8 Bayer dither.
+
+    Every pixel is compared against a fixed threshold map in one C-level
+    pass.  The pattern is stable, so unchanged regions dither to the same
+    bits from frame to frame, which keeps partial refreshes small.
+    """
+    tile = _bayer_tile(image.size)
+    # Pixels brighter than their threshold come out non-zero and turn white
+    return ImageChops.subtract(image, tile).point(_NONZERO, '1')
+
+
+def atkinson(image):
+    """
+    Atkinson error diffusion: spreads 3/4 of the error, giving the
+    higher-contrast look of classic Mac dithering.
+    """
+    width, height = image.size
+    # Pad one column left, two right and two rows below to skip bounds checks
+    stride = width + 3
+    buf = [0] * (stride * (height + 2))
+    data = image.tobytes()
+    for y in range(height):
+        row = y * stride + 1
+        buf[row:row + width] = data[y * width:(y + 1) * width]
+
+    out = bytearray(width * height)
+    for y in range(height):
+        i = y * stride + 1
+        o = y * width
+        for _ in range(width):
+            old = buf[i]
+            if old >= 128:
+                out[o] = 255
+                err = (old - 255) >> 3
+            else:
+                err = old >> 3
+            if err:
+                buf[i + 1] += err
+                buf[i + 2] += err
+                buf[i + stride - 1] += err
+                buf[i + stride] += err
+                buf[i + stride + 1] += err
+                buf[i + 2 * stride] += err
+            i += 1
+            o += 1
+
+    return Image.frombytes('L', (width, height), bytes(out)).convert('1', dither=Image.Dither.NONE)
+
+
+def floyd_steinberg(image):
+    """
+    Pillow's built-in Floyd-Steinberg error diffusion.
+    """
+    return image.convert('1', dither=Image.Dither.FLOYDSTEINBERG)
+
+
+MODES = {
+    THRESHOLD: threshold,
+    BAYER: bayer,
+    ATKINSON: atkinson,
+    FLOYD_STEINBERG: floyd_steinberg,
+}
+
+
+def dither(image, mode=DEFAULT):
+    """
+    Convert an `L` image to 1-bit with the named dithering mode.
+    """
+    try:
+        return MODES[mode](image)
+    except KeyError:
+        raise ValueError(f"Unknown dither mode: {mode!r} (options: {', '.join(MODES)})") from None
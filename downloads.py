@@ -0,0 +1,223 @@
+import email.utils
+import hashlib
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pipeline import bounded_ordered_map
+
+# Every Picker download comes from the same Google host, so the pool limit
+# is effectively the per-host limit as well
+DEFAULT_CONCURRENCY = 6
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+CHUNK_SIZE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class IncompleteDownload(Exception):
+    """
+    The body ended before the advertised length; the transfer is retried
+    from where it stopped.
+    """
+
+
+def make_client(token, concurrency=DEFAULT_CONCURRENCY):
+    """
+    One keep-alive connection pool shared by every download in a batch.
+    HTTP/2 is used when the optional `h2` package is installed.
+
+    `token` is an access token, or a function returning the current one;
+    a function is called for every request, so a long import carries on
+    across token refreshes.
+    """
+    import httpx
+
+    try:
+        import h2  # noqa: F401
+        http2 = True
+    except ImportError:
+        http2 = False
+
+    get_token = token if callable(token) else lambda: token
+
+    def authorize(request):
+        request.headers["Authorization"] = f"Bearer {get_token()}"
+
+    return httpx.Client(
+        event_hooks={"request": [authorize]},
+        limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+        timeout=httpx.Timeout(30.0, connect=10.0),
+        follow_redirects=True,
+        http2=http2,
+    )
+
+
+def retry_after(response):
+    """
+    Seconds to wait according to a Retry-After header, or None.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def backoff(attempt):
+    # Full jitter so parallel workers do not retry in lockstep
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def stream(client, url, handle, headers=None):
+    """
+    GET url and pass the open response to handle(response), retrying
+    429/5xx responses, connection errors and truncated bodies with
+    exponential backoff. `headers`, if given, is called before every attempt
+    for extra request headers. Returns whatever handle returns.
+    """
+    import httpx
+
+    for attempt in range(MAX_ATTEMPTS):
+        last = attempt == MAX_ATTEMPTS - 1
+        try:
+            with client.stream("GET", url, headers=headers() if headers else None) as response:
+                if response.status_code in RETRY_STATUSES and not last:
+                    delay = retry_after(response)
+                    if delay is None:
+                        delay = backoff(attempt)
+                    logger.warning(f"HTTP {response.status_code} for download, retrying in {delay:.1f}s")
+                    time.sleep(min(delay, BACKOFF_MAX))
+                    continue
+                response.raise_for_status()
+                return handle(response)
+        except (httpx.TransportError, IncompleteDownload) as e:
+            if last:
+                raise
+            delay = backoff(attempt)
+            logger.warning(f"Download failed ({e!r}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def _fsync_dir(path):
+    fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _content_range(response):
+    # "bytes <start>-<end>/<total>"; total may be "*"
+    spec = response.headers.get("Content-Range", "")
+    try:
+        span, total = spec.split(" ", 1)[1].split("/")
+        start = int(span.split("-")[0])
+    except (IndexError, ValueError):
+        raise IncompleteDownload(f"Malformed Content-Range: {spec!r}") from None
+    return start, None if total == "*" else int(total)
+
+
+def fetch_to_file(client, url, path):
+    """
+    Stream url into path chunk by chunk, never holding the body in memory.
+
+    An existing file at path is treated as an interrupted earlier attempt
+    and resumed with an HTTP Range request.  Returns (sha256 hex digest,
+    size) once the whole body is on disk, fsynced and matches the length the
+    server advertised; raises otherwise, leaving path in place to resume.
+    A body sent without a usable length is not resumed, and the size can
+    not be checked, so callers should validate the content themselves.
+    """
+    import httpx
+
+    def range_header():
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        return {"Range": f"bytes={offset}-"} if offset else {}
+
+    def handle(response):
+        sha = hashlib.sha256()
+        if response.status_code == 206:
+            start, total = _content_range(response)
+            # Hash the bytes we already have so the digest covers the file
+            remaining = start
+            with open(path, "rb") as f:
+                while remaining:
+                    chunk = f.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise IncompleteDownload("Partial file is shorter than the resumed range")
+                    sha.update(chunk)
+                    remaining -= len(chunk)
+            mode = "r+b"
+        else:
+            start = 0
+            length = response.headers.get("Content-Length")
+            # With a Content-Encoding the length is of the encoded body
+            total = int(length) if length and "Content-Encoding" not in response.headers else None
+            mode = "wb"
+
+        try:
+            with open(path, mode) as f:
+                f.seek(start)
+                f.truncate()
+                for chunk in response.iter_bytes(CHUNK_SIZE):
+                    sha.update(chunk)
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+                size = f.tell()
+        except BaseException:
+            if total is None:
+                # No length to check a resumed body against: start over
+                os.remove(path)
+            raise
+        if total is not None and size != total:
+            raise IncompleteDownload(f"Got {size} of {total} bytes")
+        return sha.hexdigest(), size
+
+    try:
+        return stream(client, url, handle, range_header)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code != 416:
+            raise
+        # Our partial file does not fit what the server has now: start over
+        os.remove(path)
+        return stream(client, url, handle, range_header)
+
+
+def save(client, url, path):
+    """
+    Download url to path atomically: the body goes to `path.part`
+    (resumable), and is renamed into place only once it is complete.
+    Returns the sha256 hex digest.
+    """
+    part_path = path + ".part"
+    digest, _ = fetch_to_file(client, url, part_path)
+    os.replace(part_path, path)
+    _fsync_dir(path)
+    return digest
+
+
+def download_all(items, fetch, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Run fetch(item) for every item on a bounded pool of worker threads.
+
+    `items` may be a lazy iterator (e.g. API pages still arriving): it is
+    only advanced while fewer than 2 x concurrency downloads are queued or
+    in flight, so a huge pick never piles up in memory.  Yields
+    (item, result, error) in the order of `items`; exactly one of result
+    and error is None.
+    """
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="download") as executor:
+        yield from bounded_ordered_map(lambda item: executor.submit(fetch, item), items, 2 * concurrency)
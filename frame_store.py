@@ -0,0 +1,87 @@
+import mmap
+import os
+from lib import framebuffer
+from lib.epd2in13_V2 import EPD_WIDTH, EPD_HEIGHT
+
+# One packed panel buffer per record, addressed by image id.  Records are
+# page-sized so a frame is always a single page-cache read; the byte after
+# the frame marks the record as written.
+FRAME_SIZE = framebuffer.linewidth(EPD_WIDTH) * EPD_HEIGHT
+RECORD_SIZE = 4096
+PRESENT = 0xA5
+
+
+class FrameStore:
+    """
+    Fixed-record, memory-mapped store of pre-rendered panel buffers.
+
+    The file is shared between the ingest server and the display loop; each
+    side remaps when it sees the file grow.  Unwritten records are sparse.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._map = None
+        self._size = 0
+        self._remap()
+
+    def _remap(self):
+        size = os.fstat(self._fd).st_size
+        if size == self._size and self._map is not None:
+            return
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._size = size
+        if size:
+            self._map = mmap.mmap(self._fd, size)
+
+    def _offset(self, image_id):
+        if image_id < 0:
+            raise ValueError(f"Invalid image id: {image_id}")
+        return image_id * RECORD_SIZE
+
+    def get(self, image_id):
+        """
+        Return the stored frame for `image_id`, or None if it was never rendered.
+        """
+        offset = self._offset(image_id)
+        if offset + RECORD_SIZE > self._size:
+            self._remap()
+            if offset + RECORD_SIZE > self._size:
+                return None
+        if self._map[offset + FRAME_SIZE] != PRESENT:
+            return None
+        return self._map[offset:offset + FRAME_SIZE]
+
+    def put(self, image_id, frame):
+        """
+        Store a packed frame for `image_id`.
+        """
+        if len(frame) != FRAME_SIZE:
+            raise ValueError(f"Frame must be {FRAME_SIZE} bytes, got {len(frame)}")
+        offset = self._offset(image_id)
+        if offset + RECORD_SIZE > self._size:
+            self._remap()
+            if offset + RECORD_SIZE > self._size:
+                os.ftruncate(self._fd, offset + RECORD_SIZE)
+                self._remap()
+        # Clear the marker first so a concurrent reader never sees a torn frame.
+        self._map[offset + FRAME_SIZE] = 0
+        self._map[offset:offset + FRAME_SIZE] = frame
+        self._map[offset + FRAME_SIZE] = PRESENT
+
+    def discard(self, image_id):
+        """
+        Forget the frame for `image_id`, if any.
+        """
+        offset = self._offset(image_id)
+        if offset + RECORD_SIZE <= self._size:
+            self._map[offset + FRAME_SIZE] = 0
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        os.close(self._fd)
@@ -1,40 +1,76 @@
+import json
 import os
-from googleapiclient.discovery import build
+import threading
+import time
+from datetime import datetime, timezone
+import httplib2
+import google_auth_httplib2
+import requests
+from googleapiclient.discovery import build_from_document, DISCOVERY_URI, V2_DISCOVERY_URI
+from googleapiclient.http import HttpRequest
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow, Flow
 
-def create_service(client_secret_file, api_name, api_version, *scopes, prefix="", host_ip=None):
-    # Constants
-    CLIENT_SECRET_FILE = client_secret_file
-    API_NAME = api_name
-    API_VERSION = api_version
-    SCOPES = [scope for scope in scopes[0]]
+# Discovery documents are cached here and re-fetched after this many seconds;
+# a stale copy is still used if the network is down
+DISCOVERY_DIR = 'discovery_cache'
+DISCOVERY_MAX_AGE = 7 * 24 * 3600
+
+# Refresh the access token this long before it expires, so a download
+# started just before expiry does not fail halfway
+TOKEN_REFRESH_MARGIN = 300
+
+# One Credentials object per token file, shared by API calls and downloads
+_credentials = {}
+_credentials_lock = threading.Lock()
 
-    # Directory for storing tokens
+
+def _token_path(api_name, api_version, prefix=""):
     working_dir = os.getcwd()
     token_dir = 'token_files'
-    token_file = f"token_{API_NAME}_{API_VERSION}{prefix}.json"
-    token_path = os.path.join(working_dir, token_dir, token_file)
+    token_file = f"token_{api_name}_{api_version}{prefix}.json"
+    return os.path.join(working_dir, token_dir, token_file)
+
+
+def get_credentials(client_secret_file, api_name, api_version, scopes, prefix="", host_ip=None, interactive=True):
+    """
+    Shared, valid Credentials for an API, loading them from the token file
+    or running the OAuth flow the first time. Returns None on failure.
+    Background threads pass interactive=False: they fail instead of
+    starting a sign-in nobody is there to complete.
+    """
+    token_path = _token_path(api_name, api_version, prefix)
+    with _credentials_lock:
+        creds = _credentials.get(token_path)
+        if creds is None:
+            creds = _load_credentials(client_secret_file, token_path, list(scopes), host_ip, interactive)
+            if creds is not None:
+                _credentials[token_path] = creds
+        return creds
 
+
+def _load_credentials(client_secret_file, token_path, scopes, host_ip, interactive=True):
     # Ensure the token directory exists
-    if not os.path.exists(os.path.join(working_dir, token_dir)):
-        os.mkdir(os.path.join(working_dir, token_dir))
+    if not os.path.exists(os.path.dirname(token_path)):
+        os.mkdir(os.path.dirname(token_path))
 
     # Load existing credentials
     creds = None
     if os.path.exists(token_path):
-        creds = Credentials.from_authorized_user_file(token_path, SCOPES)
+        creds = Credentials.from_authorized_user_file(token_path, scopes)
 
     # Refresh or obtain new credentials
     if not creds or not creds.valid:
         try:
             if creds and creds.expired and creds.refresh_token:
                 creds.refresh(Request())
+            elif not interactive:
+                raise RuntimeError("no valid token and no one to sign in")
             else:
                 if host_ip:  # Device flow for SSH (No browser support)
                     print("Using device flow authentication...")
-                    flow = Flow.from_client_secrets_file(CLIENT_SECRET_FILE, scopes=SCOPES)
+                    flow = Flow.from_client_secrets_file(client_secret_file, scopes=scopes)
                     flow.redirect_uri = "urn:ietf:wg:oauth:2.0:oob"
                     auth_url, _ = flow.authorization_url(prompt='consent')
                     print(f"Go to the following URL in a browser on any device:\n{auth_url}")
@@ -42,24 +78,122 @@ def create_service(client_secret_file, api_name, api_version, *scopes, prefix=""
                     flow.fetch_token(code=code)
                     creds = flow.credentials
                 else:  # Local server flow (supports browser)
-                    flow = InstalledAppFlow.from_client_secrets_file(CLIENT_SECRET_FILE, SCOPES)
+                    flow = InstalledAppFlow.from_client_secrets_file(client_secret_file, scopes)
                     creds = flow.run_local_server(port=0, success_message="Authentication complete. You may close this window.")
-            
+
             # Save the credentials
-            with open(token_path, 'w') as token:
-                token.write(creds.to_json())
+            _save_credentials(creds, token_path)
         except Exception as e:
             print(f"Authentication error: {e}")
             return None
+    return creds
+
+
+def _save_credentials(creds, token_path):
+    with open(token_path, 'w') as token:
+        token.write(creds.to_json())
+
+
+def access_token(creds):
+    """
+    A current access token from shared credentials, refreshed in-process
+    (and written back to the token file) shortly before it expires.
+    """
+    with _credentials_lock:
+        # google-auth keeps expiry as naive UTC
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        expiring = creds.expiry is not None and (creds.expiry - now).total_seconds() < TOKEN_REFRESH_MARGIN
+        if not creds.valid or expiring:
+            creds.refresh(Request())
+            for token_path, shared in _credentials.items():
+                if shared is creds:
+                    _save_credentials(creds, token_path)
+        return creds.token
+
+
+def load_discovery_document(api_name, api_version):
+    """
+    Discovery document for an API from the on-disk cache, fetching it when
+    missing or older than DISCOVERY_MAX_AGE. The cache file records the
+    document's revision; a failed fetch falls back to the stale copy.
+    """
+    cache_path = os.path.join(DISCOVERY_DIR, f"{api_name}.{api_version}.json")
+    cached = None
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cached = json.load(f)
+        if time.time() - cached.get('fetched', 0) < DISCOVERY_MAX_AGE:
+            return cached['document']
+
+    try:
+        document = _fetch_discovery_document(api_name, api_version)
+    except (requests.RequestException, ValueError) as e:
+        if cached is None:
+            raise
+        print(f"Could not refresh the {api_name} {api_version} discovery document ({e}); using the cached copy.")
+        return cached['document']
+
+    revision = json.loads(document).get('revision')
+    if cached is not None and cached.get('revision') != revision:
+        print(f"{api_name} {api_version} discovery document updated to revision {revision}.")
+    os.makedirs(DISCOVERY_DIR, exist_ok=True)
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'revision': revision, 'fetched': time.time(), 'document': document}, f)
+    os.replace(tmp_path, cache_path)
+    return document
+
+
+def _fetch_discovery_document(api_name, api_version):
+    # Same lookup order as googleapiclient: the central directory, then the
+    # API's own endpoint (where newer APIs such as photospicker live)
+    for template in (DISCOVERY_URI, V2_DISCOVERY_URI):
+        response = requests.get(template.format(api=api_name, apiVersion=api_version), timeout=30)
+        if response.status_code == 404:
+            continue
+        response.raise_for_status()
+        json.loads(response.text)  # refuse to cache anything that is not JSON
+        return response.text
+    raise ValueError(f"No discovery document for {api_name} {api_version}")
+
+
+def create_service(client_secret_file, api_name, api_version, *scopes, prefix="", host_ip=None):
+    SCOPES = [scope for scope in scopes[0]]
+    creds = get_credentials(client_secret_file, api_name, api_version, SCOPES, prefix=prefix, host_ip=host_ip)
+    if creds is None:
+        return None
+
+    connections = threading.local()
+
+    def authorized_http():
+        # Token refreshes all go through access_token(), under the lock and
+        # saved to the token file; this transport must not refresh on its own
+        return google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(), refresh_status_codes=())
+
+    def build_request(http, *args, **kwargs):
+        # httplib2 is not thread-safe: each thread gets its own keep-alive
+        # connection, all sharing the same credentials
+        if not hasattr(connections, 'http'):
+            connections.http = authorized_http()
+        access_token(creds)
+        return HttpRequest(connections.http, *args, **kwargs)
 
     # Build and return the service
     try:
-        service = build(API_NAME, API_VERSION, credentials=creds, static_discovery=False)
-        print(f"{API_NAME} {API_VERSION} service created successfully.")
+        document = load_discovery_document(api_name, api_version)
+        service = build_from_document(
+            document,
+            http=authorized_http(),
+            requestBuilder=build_request,
+        )
+        print(f"{api_name} {api_version} service created successfully.")
         return service
     except Exception as e:
         print(f"Unable to connect. Error: {e}")
-        print(f"Failed to create service instance for {API_NAME}. Deleting invalid token file.")
+        print(f"Failed to create service instance for {api_name}. Deleting invalid token file.")
+        token_path = _token_path(api_name, api_version, prefix)
         if os.path.exists(token_path):
             os.remove(token_path)
+        with _credentials_lock:
+            _credentials.pop(token_path, None)
         return None
@@ -0,0 +1,73 @@
+import hashlib
+import os
+import tempfile
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ImageStore:
+    """
+    Content-addressed store for downloaded originals.
+
+    Files live at `<root>/ab/cd/<sha256><ext>`: two levels of 256-way
+    sharding keep every directory small on SD-card filesystems, and
+    byte-identical downloads land on the same path, so they are stored once.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._tmp = os.path.join(root, '.tmp')
+        os.makedirs(self._tmp, exist_ok=True)
+
+    def path_for(self, digest, extension='.jpg'):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest + extension)
+
+    def partial_path(self, key):
+        """
+        Stable scratch file for an in-progress download, so an interrupted
+        transfer can be resumed after a restart.
+        """
+        safe = "".join(c if c.isalnum() or c in "-_" else "_" for c in key)
+        return os.path.join(self._tmp, safe + '.part')
+
+    def adopt(self, tmp_path, digest, extension='.jpg'):
+        """
+        Move a complete, fsynced file whose sha256 is `digest` into the
+        store. Returns its path.
+        """
+        path = self.path_for(digest, extension)
+        if os.path.exists(path):
+            # Already have these exact bytes
+            os.remove(tmp_path)
+            return path
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        os.replace(tmp_path, path)
+        # Make the rename itself durable before the DB points at the file
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return path
+
+    def write(self, chunks, extension='.jpg'):
+        """
+        Store the bytes from an iterable of chunks, hashing them on the way
+        to disk. Returns (sha256 hex digest, path).
+        """
+        sha = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self._tmp)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    sha.update(chunk)
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            digest = sha.hexdigest()
+            return digest, self.adopt(tmp_path, digest, extension)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
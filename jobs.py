@@ -0,0 +1,109 @@
+import logging
+import threading
+import time
+import db
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    """
+    The worker is stopping; raised from Progress so the handler unwinds.
+    """
+
+
+class Progress:
+    """
+    Running counters for one job, written through to the jobs table so
+    other threads (and the /jobs endpoints) can follow along.
+    """
+
+    # Write at most this often; the final state is always written
+    FLUSH_INTERVAL = 0.5
+
+    def __init__(self, conn, job_id, stopping=None):
+        self.conn = conn
+        self.job_id = job_id
+        self.stopping = stopping
+        self.counters = dict.fromkeys(db.JOB_COUNTERS, 0)
+        self._flushed = 0.0
+
+    def add(self, **deltas):
+        if self.stopping is not None and self.stopping.is_set():
+            raise JobCancelled()
+        for name, delta in deltas.items():
+            self.counters[name] += delta
+        if time.monotonic() - self._flushed >= self.FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        with db.transaction(self.conn) as cursor:
+            db.update_job(cursor, self.job_id, **self.counters)
+        self._flushed = time.monotonic()
+
+
+class JobWorker(threading.Thread):
+    """
+    Runs queued ingest jobs one at a time in the background.
+
+    Jobs are rows in the jobs table, so anything queued or interrupted
+    before a restart is picked up again when the worker starts.
+    `handler(session_id, progress)` does the actual work.
+    """
+
+    def __init__(self, db_name, handler):
+        super().__init__(name="ingest", daemon=True)
+        self.db_name = db_name
+        self.handler = handler
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def submit(self, session_id):
+        """
+        Queue an import of a Picker session; a session that already has a
+        queued, running or finished job (confirmed by hand and by the
+        poller) keeps it, while one whose job failed gets a new one.
+        """
+        conn = db.connect(self.db_name)
+        with db.transaction(conn) as cursor:
+            job_id = db.find_job(conn, session_id) or db.add_job(cursor, session_id)
+        self._wake.set()
+        return job_id
+
+    def stop(self, timeout=None):
+        """
+        Ask the worker to exit and wait for it.  A running job is abandoned
+        at its next progress update and left to resume on the next start.
+        """
+        self._stopping.set()
+        self._wake.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        conn = db.connect(self.db_name)
+        while not self._stopping.is_set():
+            self._wake.clear()
+            with db.transaction(conn) as cursor:
+                job = db.claim_job(cursor)
+            if job is None:
+                if not self._stopping.is_set():
+                    self._wake.wait()
+                continue
+
+            job_id, session_id = job
+            logger.info(f"Starting ingest job {job_id}")
+            progress = Progress(conn, job_id, self._stopping)
+            error = None
+            try:
+                self.handler(session_id, progress)
+            except JobCancelled:
+                logger.info(f"Ingest job {job_id} interrupted")
+                return
+            except Exception as e:
+                logger.exception(f"Ingest job {job_id} failed")
+                error = str(e) or type(e).__name__
+            progress.flush()
+            with db.transaction(conn) as cursor:
+                db.finish_job(cursor, job_id, error)
+            logger.info(f"Finished ingest job {job_id}: {progress.counters}")
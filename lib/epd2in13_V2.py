@@ -29,7 +29,10 @@
 
 
 import logging
+import time
+from collections import deque
 from . import epdconfig
+from . import framebuffer
 
 # Display resolution
 EPD_WIDTH       = 122
@@ -45,6 +48,10 @@ class EPD:
         self.cs_pin = epdconfig.CS_PIN
         self.width = EPD_WIDTH
         self.height = EPD_HEIGHT
+        self.busy_timeout_ms = 10000
+        # (command that started the wait, milliseconds spent BUSY)
+        self.busy_log = deque(maxlen=64)
+        self.last_command = None
         
     FULL_UPDATE = 0
     PART_UPDATE = 1
@@ -94,6 +101,7 @@ class EPD:
         epdconfig.delay_ms(200)   
 
     def send_command(self, command):
+        self.last_command = command
         epdconfig.digital_write(self.dc_pin, 0)
         epdconfig.digital_write(self.cs_pin, 0)
         epdconfig.spi_writebyte([command])
@@ -105,27 +113,37 @@ class EPD:
         epdconfig.spi_writebyte([data])
         epdconfig.digital_write(self.cs_pin, 1)
 
-    # send a lot of data   
+    # send a lot of data (bytes, bytearray or memoryview) in one burst
     def send_data2(self, data):
         epdconfig.digital_write(self.dc_pin, 1)
         epdconfig.digital_write(self.cs_pin, 0)
         epdconfig.spi_writebyte2(data)
         epdconfig.digital_write(self.cs_pin, 1)
+
+    # command byte followed by its whole payload as a single data transfer
+    def send(self, command, data=b''):
+        self.send_command(command)
+        if data:
+            self.send_data2(data)
         
     def ReadBusy(self):
-        while(epdconfig.digital_read(self.busy_pin) == 1):      # 0: idle, 1: busy
-            epdconfig.delay_ms(100)    
+        start = time.monotonic()
+        if not epdconfig.wait_busy(self.busy_timeout_ms):      # 0: idle, 1: busy
+            raise TimeoutError(
+                "e-Paper stayed busy for %d ms after command 0x%02X; is the panel connected?"
+                % (self.busy_timeout_ms, self.last_command or 0))
+        elapsed_ms = (time.monotonic() - start) * 1000.0
+        self.busy_log.append((self.last_command, elapsed_ms))
+        logger.debug("busy %.1f ms after 0x%02X" % (elapsed_ms, self.last_command or 0))
 
     def TurnOnDisplay(self):
-        self.send_command(0x22)
-        self.send_data(0xC7)
-        self.send_command(0x20)        
+        self.send(0x22, b'\xC7')
+        self.send_command(0x20)
         self.ReadBusy()
         
     def TurnOnDisplayPart(self):
-        self.send_command(0x22)
-        self.send_data(0x0c)
-        self.send_command(0x20)        
+        self.send(0x22, b'\x0C')
+        self.send_command(0x20)
         self.ReadBusy()
         
     def init(self, update):
@@ -134,166 +152,76 @@ class EPD:
         # EPD hardware init start
         self.reset()
         if(update == self.FULL_UPDATE):
-            self.ReadBusy()
-            self.send_command(0x12) # soft reset
-            self.ReadBusy()
-
-            self.send_command(0x74) #set analog block control
-            self.send_data(0x54)
-            self.send_command(0x7E) #set digital block control
-            self.send_data(0x3B)
-
-            self.send_command(0x01) #Driver output control
-            self.send_data(0xF9)
-            self.send_data(0x00)
-            self.send_data(0x00)
-
-            self.send_command(0x11) #data entry mode
-            self.send_data(0x01)
-
-            self.send_command(0x44) #set Ram-X address start/end position
-            self.send_data(0x00)
-            self.send_data(0x0F)    #0x0C-->(15+1)*8=128
-
-            self.send_command(0x45) #set Ram-Y address start/end position
-            self.send_data(0xF9)   #0xF9-->(249+1)=250
-            self.send_data(0x00)
-            self.send_data(0x00)
-            self.send_data(0x00)
-            
-            self.send_command(0x3C) #BorderWavefrom
-            self.send_data(0x03)
-
-            self.send_command(0x2C)     #VCOM Voltage
-            self.send_data(0x55)    #
-
-            self.send_command(0x03)
-            self.send_data(self.lut_full_update[70])
-
-            self.send_command(0x04) #
-            self.send_data(self.lut_full_update[71])
-            self.send_data(self.lut_full_update[72])
-            self.send_data(self.lut_full_update[73])
-
-            self.send_command(0x3A)     #Dummy Line
-            self.send_data(self.lut_full_update[74])
-            self.send_command(0x3B)     #Gate time
-            self.send_data(self.lut_full_update[75])
-
-            self.send_command(0x32)
-            for count in range(70):
-                self.send_data(self.lut_full_update[count])
-
-            self.send_command(0x4E)   # set RAM x address count to 0
-            self.send_data(0x00)
-            self.send_command(0x4F)   # set RAM y address count to 0X127
-            self.send_data(0xF9)
-            self.send_data(0x00)
-            self.ReadBusy()
+            self.init_full()
         else:
-            self.send_command(0x2C)     #VCOM Voltage
-            self.send_data(0x26)
-
-            self.ReadBusy()
-
-            self.send_command(0x32)
-            for count in range(70):
-                self.send_data(self.lut_partial_update[count])
-
-            self.send_command(0x37)
-            self.send_data(0x00)
-            self.send_data(0x00)
-            self.send_data(0x00)
-            self.send_data(0x00)
-            self.send_data(0x40)
-            self.send_data(0x00)
-            self.send_data(0x00)
-
-            self.send_command(0x22)
-            self.send_data(0xC0)
-            self.send_command(0x20)
-            self.ReadBusy()
-
-            self.send_command(0x3C) #BorderWavefrom
-            self.send_data(0x01)
+            self.init_partial()
         return 0
 
+    # Register setup and full-refresh LUT; needs a hardware reset first
+    def init_full(self):
+        lut = self.lut_full_update
+        self.ReadBusy()
+        self.send_command(0x12) # soft reset
+        self.ReadBusy()
+
+        self.send(0x74, b'\x54')              #set analog block control
+        self.send(0x7E, b'\x3B')              #set digital block control
+        self.send(0x01, b'\xF9\x00\x00')      #Driver output control
+        self.send(0x11, b'\x01')              #data entry mode
+        self.send(0x44, b'\x00\x0F')          #set Ram-X address start/end position, 0x0C-->(15+1)*8=128
+        self.send(0x45, b'\xF9\x00\x00\x00')  #set Ram-Y address start/end position, 0xF9-->(249+1)=250
+        self.send(0x3C, b'\x03')              #BorderWavefrom
+        self.send(0x2C, b'\x55')              #VCOM Voltage
+
+        self.send(0x03, bytes(lut[70:71]))
+        self.send(0x04, bytes(lut[71:74]))
+        self.send(0x3A, bytes(lut[74:75]))    #Dummy Line
+        self.send(0x3B, bytes(lut[75:76]))    #Gate time
+        self.send(0x32, bytes(lut[0:70]))
+
+        self.send(0x4E, b'\x00')              # set RAM x address count to 0
+        self.send(0x4F, b'\xF9\x00')          # set RAM y address count to 0X127
+        self.ReadBusy()
+
+    # Partial-refresh LUT and settings
+    def init_partial(self):
+        self.send(0x2C, b'\x26')              #VCOM Voltage
+
+        self.ReadBusy()
+
+        self.send(0x32, bytes(self.lut_partial_update[0:70]))
+        self.send(0x37, b'\x00\x00\x00\x00\x40\x00\x00')
+
+        self.send(0x22, b'\xC0')
+        self.send_command(0x20)
+        self.ReadBusy()
+
+        self.send(0x3C, b'\x01')              #BorderWavefrom
+
     def getbuffer(self, image):
-        if self.width%8 == 0:
-            linewidth = int(self.width/8)
-        else:
-            linewidth = int(self.width/8) + 1
-         
-        buf = [0xFF] * (linewidth * self.height)
-        image_monocolor = image.convert('1')
-        imwidth, imheight = image_monocolor.size
-        pixels = image_monocolor.load()
-        
-        if(imwidth == self.width and imheight == self.height):
-            logger.debug("Vertical")
-            for y in range(imheight):
-                for x in range(imwidth):                    
-                    if pixels[x, y] == 0:
-                        x = imwidth - x
-                        buf[int(x / 8) + y * linewidth] &= ~(0x80 >> (x % 8))
-        elif(imwidth == self.height and imheight == self.width):
-            logger.debug("Horizontal")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    newx = y
-                    newy = self.height - x - 1
-                    if pixels[x, y] == 0:
-                        newy = imwidth - newy - 1
-                        buf[int(newx / 8) + newy*linewidth] &= ~(0x80 >> (y % 8))
-        return buf   
+        return framebuffer.pack(image, self.width, self.height)
         
         
     def display(self, image):
-        self.send_command(0x24)
-        self.send_data2(image)   
+        self.send(0x24, image)
         self.TurnOnDisplay()
         
     def displayPartial(self, image):
-        if self.width%8 == 0:
-            linewidth = int(self.width/8)
-        else:
-            linewidth = int(self.width/8) + 1
-
-        buf = [0x00] * self.height * linewidth
-        for j in range(0, self.height):
-            for i in range(0, linewidth):
-                buf[i + j * linewidth] = ~image[i + j * linewidth]
+        buf = framebuffer.invert(image)
 
-        self.send_command(0x24)
-        self.send_data2(image)   
-                
-                
-        self.send_command(0x26)
-        self.send_data2(buf)  
+        self.send(0x24, image)
+        self.send(0x26, buf)
         self.TurnOnDisplayPart()
 
     def displayPartBaseImage(self, image):
-        self.send_command(0x24)
-        self.send_data2(image)   
-                
-        self.send_command(0x26)
-        self.send_data2(image)  
+        self.send(0x24, image)
+        self.send(0x26, image)
         self.TurnOnDisplay()
     
     def Clear(self, color=0xFF):
-        if self.width%8 == 0:
-            linewidth = int(self.width/8)
-        else:
-            linewidth = int(self.width/8) + 1
-        # logger.debug(linewidth)
-        
-        buf = [0x00] * self.height * linewidth
-        for j in range(0, self.height):
-            for i in range(0, linewidth):
-                buf[i + j * linewidth] = color
+        buf = framebuffer.fill(color, self.width, self.height)
 
-        self.send_command(0x24)
-        self.send_data2(buf)
+        self.send(0x24, buf)
                 
         # self.send_command(0x26)
         # for j in range(0, self.height):
@@ -307,10 +235,13 @@ class EPD:
         # self.send_data(0xC3)
         # self.send_command(0x20)
 
-        self.send_command(0x10) #enter deep sleep
-        self.send_data(0x03)
+        self.deep_sleep()
         epdconfig.delay_ms(2000)
         epdconfig.module_exit()
 
+    # Deep sleep keeps power and SPI up; only a hardware reset wakes the panel
+    def deep_sleep(self):
+        self.send(0x10, b'\x03') #enter deep sleep
+
 ### END OF FILE ###
 
@@ -31,13 +31,21 @@ import os
 import logging
 import sys
 import time
-import subprocess
 
-from ctypes import *
 
 logger = logging.getLogger(__name__)
 
 
+def poll_busy(read_busy, timeout_ms, step_ms=5):
+    # Fallback for backends without edge events; returns False on timeout
+    deadline = time.monotonic() + timeout_ms / 1000.0
+    while read_busy() == 1:
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(step_ms / 1000.0)
+    return True
+
+
 class RaspberryPi:
     # Pin definition
     RST_PIN  = 17
@@ -47,6 +55,7 @@ class RaspberryPi:
     PWR_PIN  = 18
     MOSI_PIN = 10
     SCLK_PIN = 11
+    SPI_SPEED_HZ = 4000000
 
     def __init__(self):
         import spidev
@@ -98,12 +107,21 @@ class RaspberryPi:
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
+    def wait_busy(self, timeout_ms):
+        # Edge-triggered: gpiozero wakes us as soon as BUSY drops
+        return self.GPIO_BUSY_PIN.wait_for_release(timeout_ms / 1000.0)
+
     def spi_writebyte(self, data):
         self.SPI.writebytes(data)
 
     def spi_writebyte2(self, data):
+        # writebytes2 takes bytes/bytearray/memoryview as-is and splits them
+        # at the spidev bufsiz itself, so frames go out without a copy
         self.SPI.writebytes2(data)
 
+    def set_spi_speed(self, hz):
+        self.SPI_SPEED_HZ = hz
+
     def DEV_SPI_write(self, data):
         self.DEV_SPI.DEV_SPI_SendData(data)
 
@@ -131,6 +149,7 @@ class RaspberryPi:
                 else:
                     so_filename = os.path.join(find_dir, 'DEV_Config_32.so')
                 if os.path.exists(so_filename):
+                    from ctypes import CDLL
                     self.DEV_SPI = CDLL(so_filename)
                     break
             if self.DEV_SPI is None:
@@ -141,7 +160,7 @@ class RaspberryPi:
         else:
             # SPI device, bus = 0, device = 0
             self.SPI.open(0, 0)
-            self.SPI.max_speed_hz = 4000000
+            self.SPI.max_speed_hz = self.SPI_SPEED_HZ
             self.SPI.mode = 0b00
         return 0
 
@@ -201,12 +220,20 @@ class JetsonNano:
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
+    def wait_busy(self, timeout_ms):
+        return poll_busy(lambda: self.digital_read(self.BUSY_PIN), timeout_ms)
+
     def spi_writebyte(self, data):
         self.SPI.SYSFS_software_spi_transfer(data[0])
 
     def spi_writebyte2(self, data):
-        for i in range(len(data)):
-            self.SPI.SYSFS_software_spi_transfer(data[i])
+        # Software SPI only moves one byte per call; keep the loop lean
+        transfer = self.SPI.SYSFS_software_spi_transfer
+        for byte in bytes(data):
+            transfer(byte)
+
+    def set_spi_speed(self, hz):
+        pass  # bit-banged, no clock to configure
 
     def module_init(self):
         self.GPIO.setmode(self.GPIO.BCM)
@@ -242,6 +269,7 @@ class SunriseX3:
     BUSY_PIN = 24
     PWR_PIN  = 18
     Flag     = 0
+    SPI_SPEED_HZ = 4000000
 
     def __init__(self):
         import spidev
@@ -259,13 +287,19 @@ class SunriseX3:
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
+    def wait_busy(self, timeout_ms):
+        return poll_busy(lambda: self.digital_read(self.BUSY_PIN), timeout_ms)
+
     def spi_writebyte(self, data):
         self.SPI.writebytes(data)
 
     def spi_writebyte2(self, data):
         # for i in range(len(data)):
         #     self.SPI.writebytes([data[i]])
-        self.SPI.xfer3(data)
+        self.SPI.writebytes2(data)
+
+    def set_spi_speed(self, hz):
+        self.SPI_SPEED_HZ = hz
 
     def module_init(self):
         if self.Flag == 0:
@@ -282,7 +316,7 @@ class SunriseX3:
         
             # SPI device, bus = 0, device = 0
             self.SPI.open(2, 0)
-            self.SPI.max_speed_hz = 4000000
+            self.SPI.max_speed_hz = self.SPI_SPEED_HZ
             self.SPI.mode = 0b00
             return 0
         else:
@@ -301,22 +335,253 @@ class SunriseX3:
         self.GPIO.cleanup([self.RST_PIN, self.DC_PIN, self.CS_PIN, self.BUSY_PIN], self.PWR_PIN)
 
 
-if sys.version_info[0] == 2:
-    process = subprocess.Popen("cat /proc/cpuinfo | grep Raspberry", shell=True, stdout=subprocess.PIPE)
-else:
-    process = subprocess.Popen("cat /proc/cpuinfo | grep Raspberry", shell=True, stdout=subprocess.PIPE, text=True)
-output, _ = process.communicate()
-if sys.version_info[0] == 2:
-    output = output.decode(sys.stdout.encoding)
+class Virtual:
+    # Pin definition (same numbering as the Raspberry Pi HAT)
+    RST_PIN  = 17
+    DC_PIN   = 25
+    CS_PIN   = 8
+    BUSY_PIN = 24
+    PWR_PIN  = 18
+    SPI_SPEED_HZ = 4000000
+
+    # Visible source lines of the simulated 2.13inch panel; RAM is 128 wide
+    WIDTH = 122
+
+    # Modelled BUSY time per operation, in ms.  0x22 selects the update
+    # sequence that 0x20 (master activation) then runs.
+    SOFT_RESET_MS = 10
+    UPDATE_MS = {
+        0xC7: 2000,  # full refresh waveform
+        0x0C: 300,   # partial refresh waveform
+        0xC0: 40,    # clock + analog enable only
+    }
+
+    def __init__(self):
+        # Env: EPD_VIRTUAL_OUTPUT=<dir> dumps a PNG per refresh,
+        # EPD_VIRTUAL_TIME_SCALE scales all modelled delays (0 = instant)
+        self.output_dir = os.environ.get('EPD_VIRTUAL_OUTPUT')
+        self.time_scale = float(os.environ.get('EPD_VIRTUAL_TIME_SCALE', '1'))
+        self._pins = {self.RST_PIN: 0, self.DC_PIN: 0, self.CS_PIN: 1, self.PWR_PIN: 0}
+        self.stats = {'refresh_full': 0, 'refresh_partial': 0, 'spi_bytes': 0, 'busy_ms': 0.0}
+        self._frame_count = 0
+        self._displayed = None
+        self._reset_controller()
+
+    def _reset_controller(self):
+        self._command = None
+        self._args = bytearray()
+        self._busy_until = 0.0
+        self._asleep = False
+        self._update_control = 0xC7
+        self._entry_mode = 0x03
+        self._x_window = (0x00, 0x0F)
+        self._y_window = (0x00, 0xF9)
+        self._x = 0
+        self._y = 0
+        self._ram = {0x24: bytearray(b'\xFF' * 16 * 250), 0x26: bytearray(b'\xFF' * 16 * 250)}
+
+    def _sleep(self, seconds):
+        if seconds > 0 and self.time_scale > 0:
+            time.sleep(seconds * self.time_scale)
+
+    def _set_busy(self, ms):
+        self._busy_until = time.monotonic() + ms * self.time_scale / 1000.0
+        self.stats['busy_ms'] += ms
+
+    def digital_write(self, pin, value):
+        if pin == self.RST_PIN and self._pins[pin] and not value:
+            self._reset_controller()  # falling edge on RST
+        self._pins[pin] = value
+
+    def digital_read(self, pin):
+        if pin == self.BUSY_PIN:
+            return 1 if time.monotonic() < self._busy_until else 0
+        return self._pins.get(pin, 0)
+
+    def delay_ms(self, delaytime):
+        self._sleep(delaytime / 1000.0)
+
+    def wait_busy(self, timeout_ms):
+        remaining = self._busy_until - time.monotonic()
+        if remaining * 1000.0 > timeout_ms:
+            time.sleep(timeout_ms / 1000.0)
+            return False
+        if remaining > 0:
+            time.sleep(remaining)
+        return True
+
+    def spi_writebyte(self, data):
+        self.spi_writebyte2(data)
+
+    def spi_writebyte2(self, data):
+        data = bytes(data)
+        self.stats['spi_bytes'] += len(data)
+        self._sleep(len(data) * 8 / self.SPI_SPEED_HZ)
+        if self._asleep:
+            return
+        if self._pins[self.DC_PIN] == 0:
+            for byte in data:
+                self._on_command(byte)
+        elif self._command in (0x24, 0x26):
+            self._write_ram(self._ram[self._command], data)
+        else:
+            self._args.extend(data)
+            self._on_args()
+
+    def set_spi_speed(self, hz):
+        self.SPI_SPEED_HZ = hz
+
+    def _on_command(self, command):
+        self._command = command
+        self._args = bytearray()
+        if command == 0x12:
+            self._reset_controller()
+            self._set_busy(self.SOFT_RESET_MS)
+        elif command == 0x20:
+            ms = self.UPDATE_MS.get(self._update_control, self.UPDATE_MS[0xC0])
+            self._set_busy(ms)
+            if self._update_control in (0xC7, 0x0C):
+                self._refresh('full' if self._update_control == 0xC7 else 'partial')
+
+    def _on_args(self):
+        command, args = self._command, self._args
+        if command == 0x22 and len(args) == 1:
+            self._update_control = args[0]
+        elif command == 0x11 and len(args) == 1:
+            self._entry_mode = args[0]
+        elif command == 0x44 and len(args) == 2:
+            self._x_window = (args[0], args[1])
+        elif command == 0x45 and len(args) == 4:
+            self._y_window = (args[0] | args[1] << 8, args[2] | args[3] << 8)
+        elif command == 0x4E and len(args) == 1:
+            self._x = args[0]
+        elif command == 0x4F and len(args) == 2:
+            self._y = args[0] | args[1] << 8
+        elif command == 0x10 and len(args) == 1 and args[0]:
+            self._asleep = True  # only a hardware reset wakes it up
+
+    def _write_ram(self, ram, data):
+        # X-first addressing (AM = 0); the window runs from its start to
+        # its end address in whichever direction the entry mode counts
+        dx = 1 if self._entry_mode & 0x01 else -1
+        dy = 1 if self._entry_mode & 0x02 else -1
+        x_first, x_last = self._x_window
+        y_first, y_last = self._y_window
+        x, y = self._x, self._y
+        for byte in data:
+            ram[y * 16 + x] = byte
+            if x == x_last:
+                x = x_first
+                y = y_first if y == y_last else y + dy
+            else:
+                x += dx
+        self._x, self._y = x, y
+
+    def frame(self):
+        # Black/white RAM in the order the driver streams it (gate 249 first)
+        ram = self._ram[0x24]
+        y_start, y_end = self._y_window
+        step = -1 if y_start > y_end else 1
+        return b''.join(bytes(ram[y * 16:(y + 1) * 16]) for y in range(y_start, y_end + step, step))
+
+    def image(self):
+        # What the panel shows, in the landscape layout the app renders
+        from PIL import Image
+        frame = self._displayed if self._displayed is not None else self.frame()
+        rows = len(frame) // 16
+        image = Image.frombytes('1', (128, rows), frame)
+        return image.crop((0, 0, self.WIDTH, rows)).transpose(Image.TRANSPOSE)
+
+    def _refresh(self, mode):
+        self.stats['refresh_' + mode] += 1
+        self._displayed = self.frame()
+        self._frame_count += 1
+        if self.output_dir:
+            os.makedirs(self.output_dir, exist_ok=True)
+            path = os.path.join(self.output_dir, "frame_%05d_%s.png" % (self._frame_count, mode))
+            self.image().save(path)
+            logger.debug("virtual panel: %s refresh -> %s" % (mode, path))
+
+    def module_init(self, cleanup=False):
+        self._pins[self.PWR_PIN] = 1
+        return 0
+
+    def module_exit(self, cleanup=False):
+        logger.debug("spi end")
+        self._pins[self.RST_PIN] = 0
+        self._pins[self.DC_PIN] = 0
+        self._pins[self.PWR_PIN] = 0
+        logger.debug("close 5V, Module enters 0 power consumption ...")
 
-if "Raspberry" in output:
-    implementation = RaspberryPi()
-elif os.path.exists('/sys/bus/platform/drivers/gpio-x3'):
-    implementation = SunriseX3()
-else:
-    implementation = JetsonNano()
 
-for func in [x for x in dir(implementation) if not x.startswith('_')]:
-    setattr(sys.modules[__name__], func, getattr(implementation, func))
+BACKENDS = {
+    'raspberrypi': RaspberryPi,
+    'jetson': JetsonNano,
+    'sunrise': SunriseX3,
+    'virtual': Virtual,
+}
+
+_backend_name = os.environ.get('EPD_BACKEND', '').lower() or None
+_backend_class = None
+
+
+def _read_text(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read().decode('utf-8', 'replace')
+    except (IOError, OSError):
+        return ''
+
+
+def detect_backend():
+    # Plain file reads instead of spawning `cat /proc/cpuinfo | grep ...`
+    if 'Raspberry' in _read_text('/proc/device-tree/model') or 'Raspberry' in _read_text('/proc/cpuinfo'):
+        return 'raspberrypi'
+    if os.path.exists('/sys/bus/platform/drivers/gpio-x3'):
+        return 'sunrise'
+    return 'jetson'
+
+
+def select_backend(name):
+    # Must run before the first hardware call; None means auto-detect
+    global _backend_name, _backend_class
+    if 'implementation' in globals():
+        raise RuntimeError('EPD backend already initialised')
+    name = (name or '').lower()
+    if name == 'auto':
+        name = ''
+    if name and name not in BACKENDS:
+        raise ValueError('Unknown EPD backend %r (options: auto, %s)' % (name, ', '.join(BACKENDS)))
+    _backend_name = name or None
+    _backend_class = None
+
+
+def backend_class():
+    global _backend_class
+    if _backend_class is None:
+        _backend_class = BACKENDS[_backend_name or detect_backend()]
+        logger.debug("EPD backend: %s" % _backend_class.__name__)
+    return _backend_class
+
+
+def __getattr__(name):
+    # Resolved on first use so importing the driver never touches hardware.
+    # Pin numbers come straight from the backend class; anything else
+    # instantiates the backend (opening GPIO) and exports its methods.
+    if name.startswith('__'):
+        raise AttributeError(name)
+    cls = backend_class()
+    if name.endswith('_PIN') and hasattr(cls, name):
+        return getattr(cls, name)
+    module = sys.modules[__name__]
+    if 'implementation' not in module.__dict__:
+        implementation = cls()
+        module.implementation = implementation
+        for func in [x for x in dir(implementation) if not x.startswith('_')]:
+            setattr(module, func, getattr(implementation, func))
+    try:
+        return module.__dict__[name]
+    except KeyError:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 ### END OF FILE ###
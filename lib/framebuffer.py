@@ -0,0 +1,48 @@
+# Framebuffer packing helpers for the 2.13inch V2 panel.
+#
+# The controller RAM holds one bit per pixel, MSB first, with every gate line
+# padded to a whole number of bytes (122 px -> 16 bytes).  A cleared bit is a
+# black pixel.  These helpers build that layout with Pillow's C packer instead
+# of walking the image pixel by pixel in Python.
+
+
+def linewidth(width):
+    """Number of bytes per gate line for a panel `width` pixels wide."""
+    return (width + 7) // 8
+
+
+def pack(image, width, height):
+    """
+    Pack `image` into the controller RAM layout.
+
+    `image` must be either `width` x `height` ("Vertical") or
+    `height` x `width` ("Horizontal"); anything else packs to a blank frame.
+    Returns a `bytes` buffer of `linewidth(width) * height` bytes.
+    """
+    from PIL import Image  # deferred so importing the driver stays cheap
+
+    image_monocolor = image.convert('1')
+    imwidth, imheight = image_monocolor.size
+    canvas = Image.new('1', (linewidth(width) * 8, height), 255)
+
+    if imwidth == width and imheight == height:
+        # Columns are mirrored and land one bit to the right: x -> width - x.
+        canvas.paste(image_monocolor.transpose(Image.FLIP_LEFT_RIGHT), (1, 0))
+    elif imwidth == height and imheight == width:
+        # Image column x becomes gate line x, image row y becomes bit y.
+        canvas.paste(image_monocolor.transpose(Image.TRANSPOSE), (0, 0))
+
+    return canvas.tobytes()
+
+
+_INVERT = bytes(0xFF - i for i in range(256))
+
+
+def invert(buf):
+    """Return `buf` with every bit flipped, as `bytes`."""
+    return bytes(buf).translate(_INVERT)
+
+
+def fill(color, width, height):
+    """Return a frame with every byte set to `color`."""
+    return bytes([color & 0xFF]) * (linewidth(width) * height)
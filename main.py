@@ -1,13 +1,14 @@
-import httpx
-import json
-from google_apis import create_service
+import downloads
+from google_apis import access_token, create_service, get_credentials
+
+
+SCOPES = ['https://www.googleapis.com/auth/photospicker.mediaitems.readonly']
 
 
 def create_photos_picker_service(client_file):
     api_name = 'photospicker'
     version = 'v1'
-    scopes = ['https://www.googleapis.com/auth/photospicker.mediaitems.readonly']
-    return create_service(client_file, api_name, version, scopes)
+    return create_service(client_file, api_name, version, SCOPES)
 
 
 def create_session(service):
@@ -19,39 +20,33 @@ def get_session(service, session_id):
     return service.sessions().get(sessionId=session_id).execute()
 
 
-def list_all_media_items(service, session_id, page_size=100):
-    media_items = []
+def iter_media_items(service, session_id, page_size=100):
     next_page_token = None
     
     
+    # Yield each page as it arrives so downloads start before paging ends
     while True:
         response = service.mediaItems().list(sessionId=session_id, pageSize=page_size, pageToken=next_page_token).execute()
-        media_items.extend(response.get("mediaItems", []))
+        yield from response.get("mediaItems", [])
         next_page_token = response.get("nextPageToken")
         if not next_page_token:
             break
-    
-    
-    return media_items
 
 
 
-def get_auth_token(token_file):
-    with open(token_file, 'r') as token:
-        return json.load(token)["token"]
+def get_auth_token():
+    # Shared with the service and refreshed before it expires
+    return access_token(get_credentials(client_file, 'photospicker', 'v1', SCOPES))
 
 
-def download_media_item(media_item, token):
+def download_media_item(client, media_item):
     base_url = media_item["mediaFile"]["baseUrl"]
     file_name = media_item["mediaFile"]["filename"]
     download_url = f"{base_url}=d"
     
     
-    media_response = httpx.get(download_url, headers={"Authorization": f"Bearer {token}"})
-    
-    
-    with open("a" + file_name, "wb") as file:
-        file.write(media_response.content)
+    # Streamed to a .part file and renamed once complete
+    downloads.save(client, download_url, "a" + file_name)
     
     return file_name
 
@@ -73,14 +68,17 @@ import time
 time.sleep(30)
 
 
-media_items = list_all_media_items(service, session_id)
-print(f"Total Media Items: {len(media_items)}") 
-
-
+media_items = iter_media_items(service, session_id)
 
-token = get_auth_token('./token_files/token_photospicker_v1.json')
 
 
-for media_item in media_items:
-    file_name = download_media_item(media_item, token)
-    print(f"Downloaded: {file_name}")
\ No newline at end of file
+total = 0
+with downloads.make_client(get_auth_token) as client:
+    results = downloads.download_all(media_items, lambda item: download_media_item(client, item))
+    for media_item, file_name, error in results:
+        total += 1
+        if error is not None:
+            print(f"Failed: {media_item['mediaFile']['filename']}: {error}")
+            continue
+        print(f"Downloaded: {file_name}")
+print(f"Total Media Items: {total}")
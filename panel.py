@@ -0,0 +1,80 @@
+import logging
+from lib import epdconfig
+
+
+class PanelSession:
+    """
+    Long-lived handle on the e-paper controller.
+
+    `EPD.init` powers the module, opens SPI, hardware-resets the panel and
+    re-uploads the LUT on every call, and `EPD.sleep` waits two seconds and
+    powers everything down again.  The session tracks what state the
+    controller is actually in and only performs the transitions needed to
+    reach the requested refresh mode.
+    """
+
+    def __init__(self, epd, deep_sleep_after=None):
+        self.epd = epd
+        # Idle periods at least this long (seconds) are spent in deep sleep;
+        # None never deep-sleeps between frames
+        self.deep_sleep_after = deep_sleep_after
+        self.powered = False
+        self.asleep = False
+        self.lut = None  # epd.FULL_UPDATE, epd.PART_UPDATE or None before init
+
+    def wake(self, update):
+        """
+        Bring the controller up and make sure the LUT for `update` is loaded.
+        """
+        if not self.powered:
+            if epdconfig.module_init() != 0:
+                raise RuntimeError("Failed to initialise the e-paper module")
+            self.powered = True
+            self.lut = None
+
+        if self.asleep or self.lut is None:
+            # Deep sleep drops the register file; one reset brings it back
+            logging.debug("Panel: reset and full init")
+            self.epd.reset()
+            self.epd.init_full()
+            self.asleep = False
+            self.lut = self.epd.FULL_UPDATE
+
+        if self.lut != update:
+            logging.debug(f"Panel: switching LUT to {'full' if update == self.epd.FULL_UPDATE else 'partial'}")
+            if update == self.epd.FULL_UPDATE:
+                self.epd.init_full()
+            else:
+                self.epd.init_partial()
+            self.lut = update
+
+    def idle(self, seconds):
+        """
+        The panel will not be used for `seconds`.  Waking from deep sleep
+        costs a hardware reset (~400 ms) and a full register and LUT upload,
+        so the controller stays initialised, with its LUT loaded, unless the
+        gap is at least `deep_sleep_after`.
+        """
+        if self.deep_sleep_after is not None and seconds >= self.deep_sleep_after:
+            self.sleep()
+
+    def sleep(self):
+        """
+        Put the controller in deep sleep but keep the module powered.
+        """
+        if self.powered and not self.asleep:
+            self.epd.deep_sleep()
+            self.asleep = True
+
+    def close(self):
+        """
+        Deep sleep and power the module down.
+        """
+        if self.powered:
+            if self.asleep:
+                epdconfig.module_exit()
+            else:
+                self.epd.sleep()
+            self.powered = False
+            self.asleep = False
+            self.lut = None
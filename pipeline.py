@@ -0,0 +1,28 @@
+from collections import deque
+
+
+def bounded_ordered_map(submit, items, window):
+    """
+    Fan items out to an executor, at most `window` at a time, and yield
+    their outcomes in the order of `items`.
+
+    `submit(item)` starts the work and returns a Future.  `items` may be a
+    lazy iterator: it is only advanced while fewer than `window` futures are
+    queued or in flight, so a fast producer is held back by a slow consumer
+    instead of piling up in memory.  Yields (item, result, error); exactly
+    one of result and error is None.
+    """
+    pending = deque()
+    for item in items:
+        pending.append((item, submit(item)))
+        if len(pending) >= window:
+            yield _outcome(*pending.popleft())
+    while pending:
+        yield _outcome(*pending.popleft())
+
+
+def _outcome(item, future):
+    try:
+        return item, future.result(), None
+    except Exception as e:
+        return item, None, e
@@ -0,0 +1,87 @@
+import logging
+from lib import framebuffer
+
+FULL = 'full'
+PARTIAL = 'partial'
+SKIP = 'skip'
+
+
+def pixel_mask(width, height):
+    """
+    Bit mask over a packed frame with a 1 for every real pixel and a 0 for
+    the padding that rounds each gate line up to whole bytes.
+    """
+    full, rest = divmod(width, 8)
+    line = b'\xff' * full + (bytes([(0xFF << (8 - rest)) & 0xFF]) if rest else b'')
+    return int.from_bytes(line * height, 'big')
+
+
+def changed_pixels(previous, frame, mask=None):
+    """
+    Count the pixels that differ between two packed frames of the same size,
+    only within `mask` (from pixel_mask) if given.
+    """
+    diff = int.from_bytes(previous, 'big') ^ int.from_bytes(frame, 'big')
+    if mask is not None:
+        diff &= mask
+    # int.bit_count() would need Python 3.10; Pi OS images still ship 3.9
+    return bin(diff).count('1')
+
+
+class RefreshManager:
+    """
+    Chooses between full and partial refreshes by diffing consecutive frames.
+
+    A partial update skips the flashing full waveform, but it leaves ghosting
+    behind.  A full refresh is forced for the first frame, after
+    `full_every` partial updates in a row, and whenever more than
+    `max_changed` (a fraction of the panel) of the pixels change.
+    """
+
+    def __init__(self, panel, full_every=10, max_changed=0.15):
+        self.panel = panel
+        self.full_every = full_every
+        self.max_changed = max_changed
+        self.last_frame = None
+        self.partials = 0
+        # Thresholds are fractions of the real pixels, not of the padded buffer
+        epd = panel.epd
+        self.pixels = epd.width * epd.height
+        self.mask = pixel_mask(epd.width, epd.height)
+
+    def choose(self, frame):
+        """
+        Return (mode, changed pixel count) for showing `frame` next.
+        """
+        if self.last_frame is None or len(self.last_frame) != len(frame):
+            return FULL, self.pixels
+
+        changed = changed_pixels(self.last_frame, frame, self.mask)
+        if changed == 0:
+            return SKIP, 0
+        if self.partials >= self.full_every or changed > self.max_changed * self.pixels:
+            return FULL, changed
+        return PARTIAL, changed
+
+    def show(self, frame):
+        """
+        Push `frame` to the panel with the cheapest safe waveform and return the mode used.
+        """
+        mode, changed = self.choose(frame)
+
+        epd = self.panel.epd
+        epd.busy_log.clear()
+        if mode == FULL:
+            # Write both RAM banks so later partial updates have a clean base
+            self.panel.wake(epd.FULL_UPDATE)
+            epd.displayPartBaseImage(frame)
+            self.partials = 0
+        elif mode == PARTIAL:
+            self.panel.wake(epd.PART_UPDATE)
+            epd.displayPartial(frame)
+            self.partials += 1
+
+        self.last_frame = bytes(frame)
+        busy_ms = sum(ms for _, ms in epd.busy_log)
+        logging.info(f"Refresh mode: {mode} ({changed} pixels changed, {busy_ms:.0f} ms busy)")
+        return mode
@@ -0,0 +1,126 @@
+import logging
+from PIL import ExifTags, Image, ImageOps
+import dithering
+from lib import framebuffer
+from lib.epd2in13_V2 import EPD_WIDTH, EPD_HEIGHT
+
+# The panel is mounted landscape: images are laid out 250 wide, 122 tall.
+CANVAS_SIZE = (EPD_HEIGHT, EPD_WIDTH)
+
+# Decode at least this many times the panel size so the final resize still
+# has detail to average over.
+OVERSAMPLE = 2
+
+# Refuse anything that would still be this large after reduced decoding;
+# a 512 MB Pi cannot hold it in memory.
+MAX_DECODE_PIXELS = 40_000_000
+
+# EXIF orientations that swap width and height
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def _fit(size, box):
+    """
+    Scale `size` to fit inside `box`, keeping the aspect ratio.
+    """
+    scale = min(box[0] / size[0], box[1] / size[1])
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def rendition_size(oversample=OVERSAMPLE, size=CANVAS_SIZE):
+    """
+    Bounding box to request from the photo service for this panel: the
+    canvas scaled by `oversample` so dithering still has detail to work with.
+    """
+    return size[0] * oversample, size[1] * oversample
+
+
+def load_image(image_source, size=CANVAS_SIZE):
+    """
+    Load an image (path or PIL image) as an upright `L` image that fits in `size`.
+
+    JPEGs are decoded straight to grayscale at the smallest DCT scale that is
+    still at least OVERSAMPLE times the target, so a 12 MP photo never
+    exists in memory at full resolution.  Orientation is applied after that
+    reduction and the final resize happens in `L` mode.
+    """
+    if isinstance(image_source, str):
+        with Image.open(image_source) as image:
+            return fit_image(decode_image(image, size), size)
+    return fit_image(decode_image(image_source, size), size)
+
+
+def oriented_size(image):
+    """
+    Size of an opened image once its EXIF orientation is applied.
+    """
+    if image.getexif().get(ExifTags.Base.Orientation) in _TRANSPOSED_ORIENTATIONS:
+        return image.height, image.width
+    return image.size
+
+
+def decode_image(image, size=CANVAS_SIZE):
+    """
+    Decode an opened image at the smallest scale that still covers `size`.
+    """
+    # Work out the target in the file's own (un-rotated) orientation
+    box = size
+    if image.getexif().get(ExifTags.Base.Orientation) in _TRANSPOSED_ORIENTATIONS:
+        box = (size[1], size[0])
+    target = _fit(image.size, box)
+    image.draft('L', (target[0] * OVERSAMPLE, target[1] * OVERSAMPLE))
+
+    if image.width * image.height > MAX_DECODE_PIXELS:
+        raise ValueError(f"Image too large to decode: {image.width}x{image.height}")
+
+    image.load()
+    return image
+
+
+def fit_image(image, size=CANVAS_SIZE):
+    """
+    Apply EXIF orientation and resize a decoded image to fit `size` in `L` mode.
+    """
+    # Bilevel sources (QR codes, line art) stay crisp with nearest-neighbour
+    resample = Image.NEAREST if image.mode == '1' else Image.LANCZOS
+
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info):
+        # Flatten transparency onto the panel's white background
+        image = image.convert('RGBA')
+        background = Image.new('RGBA', image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image)
+    image = image.convert('L')
+    image.thumbnail(size, resample, reducing_gap=OVERSAMPLE)
+    return image
+
+
+def center_on_canvas(image):
+    """
+    Paste an `L` image onto the middle of a white panel-sized canvas.
+    """
+    canvas = Image.new('L', CANVAS_SIZE, 255)
+    x_offset = (CANVAS_SIZE[0] - image.width) // 2
+    y_offset = (CANVAS_SIZE[1] - image.height) // 2
+    canvas.paste(image, (x_offset, y_offset))
+    return canvas
+
+
+def prepare_image(image_source, dither=dithering.DEFAULT):
+    """
+    Load an image (path or PIL image), lay it out on a white panel-sized
+    canvas and dither it with the named mode.
+    """
+    canvas = center_on_canvas(load_image(image_source))
+
+    # Dither only once, at the final panel resolution
+    return dithering.dither(canvas, dither)
+
+
+def render_frame(image_source, dither=dithering.DEFAULT):
+    """
+    Run the full pipeline and return the packed panel buffer as bytes.
+    """
+    frame = framebuffer.pack(prepare_image(image_source, dither), EPD_WIDTH, EPD_HEIGHT)
+    logging.debug(f"Frame rendered: {image_source}")
+    return frame
@@ -4,7 +4,9 @@ import argparse
 import qrcode
 import requests
 from lib import epd2in13_V2
-from PIL import Image
+import dithering
+from render import render_frame
+from display_driver import open_panel
 import time
 
 # Configure logging
@@ -47,7 +49,7 @@ def get_qr_code(content: str):
     return img
 
 
-def render_image(epd, image_source):
+def render_image(epd, image_source, dither=dithering.DEFAULT):
     if isinstance(image_source, str) and image_source.startswith('http'):
         image_source = download_image(image_source)
         if not image_source:
@@ -58,23 +60,13 @@ def render_image(epd, image_source):
             logging.error(f"Image file not found: {image_source}")
             return
         logging.info(f"Rendering image from file: {image_source}")
-        image = Image.open(image_source)
     else:
         logging.info("Rendering image from object")
-        image = image_source
 
-    image = image.convert('1')  # Convert to 1-bit black-and-white
-    
-    # Maintain aspect ratio
-    image.thumbnail((epd.height, epd.width), Image.LANCZOS)
-    canvas = Image.new('1', (epd.height, epd.width), 255)  # White background
-    x_offset = (epd.height - image.width) // 2
-    y_offset = (epd.width - image.height) // 2
-    canvas.paste(image, (x_offset, y_offset))
-    image = canvas
+    frame = render_frame(image_source, dither)
 
     epd.init(epd.FULL_UPDATE)
-    epd.display(epd.getbuffer(image))
+    epd.display(frame)
     time.sleep(2)
     epd.sleep()
     logging.info("Image rendered.")
@@ -85,22 +77,23 @@ def main():
     parser.add_argument('-f', '--flush', action='store_true', help='Flush the screen to clear content')
     parser.add_argument('-i', '--image', type=str, help='Path or URL to the image file to render')
     parser.add_argument('-q', '--qr', type=str, help='Content to render as QR code')
+    parser.add_argument('-d', '--dither', choices=list(dithering.MODES), default=dithering.DEFAULT, help='Dithering mode for 1-bit conversion')
 
     args = parser.parse_args()
 
     try:
         logging.info("Initializing e-ink display")
-        epd = epd2in13_V2.EPD()
+        epd = open_panel()  # SPI clock and BUSY timeout from config.yaml
 
         if args.flush:
             flush_screen(epd)
 
         if args.image:
-            render_image(epd, args.image)
+            render_image(epd, args.image, args.dither)
         
         if args.qr:
             qr_code = get_qr_code(args.qr)
-            render_image(epd, qr_code)
+            render_image(epd, qr_code, args.dither)
 
         if not args.flush and not args.image:
             logging.warning("No actions specified. Use --flush or --image <path>.")
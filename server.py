@@ -1,18 +1,26 @@
 import logging
 import socket
+import sys
+import threading
 import time
-from flask import Flask, request, redirect, render_template
+from datetime import datetime
+from flask import Flask, Response, request, redirect, render_template
 import os
-import sqlite3
-from pyngrok import ngrok
-from PIL import Image
-import httpx
+import re
+import shutil
+import itertools
 import json
 
-import qrcode
 import yaml
-from lib import epd2in13_V2
-from google_apis import create_service
+import db
+import downloads
+import transcode
+from frame_store import FrameStore
+from image_store import ImageStore
+from jobs import JobWorker
+
+# Heavier dependencies (googleapiclient, httpx, qrcode, pyngrok, Pillow) are
+# imported where they are used so the server starts quickly on a Pi Zero.
 
 app = Flask(__name__)
 service = None
@@ -26,31 +34,31 @@ with open(CONFIG_FILE, 'r') as config_file:
 # Config Parameters
 DB_NAME = config.get('db_name', 'photos.db')
 IMAGE_FOLDER = config.get('image_folder', 'images')
+FRAME_STORE = config.get('frame_store', 'frames.bin')
+DITHER = config.get('dither', 'floyd-steinberg')
 REFRESH_RATE = config['refresh_rate']
 PLAYBACK_MODE = config['playback_mode']
-
-os.makedirs(IMAGE_FOLDER, exist_ok=True)
-
-
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-        """CREATE TABLE IF NOT EXISTS images (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        path TEXT,
-                        sequence INTEGER,
-                        last_shown BOOLEAN DEFAULT 0)"""
-    )
-    conn.commit()
-    conn.close()
-
-
-init_db()
+DOWNLOAD_CONCURRENCY = config.get('download_concurrency', downloads.DEFAULT_CONCURRENCY)
+TRANSCODE_WORKERS = config.get('transcode_workers') or transcode.default_workers()
+ARCHIVE_ORIGINALS = config.get('archive_originals', False)
+RENDITION_OVERSAMPLE = config.get('rendition_oversample', 2)
+JOB_EVENT_INTERVAL = 0.5  # seconds between progress checks on the SSE stream
+INGEST_BATCH = 16  # photos recorded per transaction during an import
+INGEST_FLUSH_INTERVAL = 2.0  # ...or this many seconds' worth, whichever comes first
+SESSION_POLL_INTERVAL = 5.0  # seconds, when the API does not suggest one
+SESSION_EXPIRY_MARGIN = 300  # start a new picker session this close to expiry
+KILL_TIMEOUT = 30  # seconds /kill waits for background threads to stop
+
+# Set up by init_storage() in the serving process only: transcode workers
+# re-import this module as __mp_main__ and must not repeat it
+image_store = None
+job_worker = None
 
 
 # Utils Functions
 def get_qr_code(content: str):
+    import qrcode
+
     qr = qrcode.QRCode(
         version=1,
         error_correction=qrcode.constants.ERROR_CORRECT_L,
@@ -64,17 +72,24 @@ def get_qr_code(content: str):
 
 
 # Google Photos Picker API setup
+PICKER_API = ("photospicker", "v1")
+PICKER_SCOPES = ["https://www.googleapis.com/auth/photospicker.mediaitems.readonly"]
+
+
 def create_photos_picker_service(client_file, host_ip=None):
-    api_name = "photospicker"
-    version = "v1"
-    scopes = ["https://www.googleapis.com/auth/photospicker.mediaitems.readonly"]
-    return create_service(client_file, api_name, version, scopes, host_ip=host_ip)
+    from google_apis import create_service
+
+    api_name, version = PICKER_API
+    return create_service(client_file, api_name, version, PICKER_SCOPES, host_ip=host_ip)
 
 
 # API and Session Configuration
 client_file = "creds.json"
 service = None
 session_id, expire_time, picker_uri = None, None, None
+session_lock = threading.Lock()
+session_watchers = []  # picker-poll threads
+stop_watching = threading.Event()
 
 
 @app.route("/")
@@ -85,11 +100,9 @@ def home():
 
 @app.route("/picker", methods=["GET"])
 def get_picker_uri():
-    global session_id, expire_time, picker_uri
     try:
-        session_id, expire_time, picker_uri = create_session(service)
         # Render a page with Picker URL and Confirm Button
-        return render_template("picker.html", picker_uri=picker_uri)
+        return render_template("picker.html", picker_uri=current_picker_uri())
     except Exception as e:
         print(f"Error during picker URI creation: {e}")
         return render_template("error.html", error_message="Failed to load Picker URI.")
@@ -97,55 +110,180 @@ def get_picker_uri():
 
 @app.route("/confirm", methods=["POST"])
 def confirm_selection():
-    global session_id
-    try:
-        token = get_auth_token("./token_files/token_photospicker_v1.json")
+    if session_id is None:
+        return render_template("error.html", error_message="No picker session to confirm.")
+
+    # Ingest runs in the background; the phone only waits for the job id
+    job_id = job_worker.submit(session_id)
+    if request.accept_mimetypes.best == "application/json":
+        return {"job_id": job_id, "status": f"/jobs/{job_id}", "events": f"/jobs/{job_id}/events"}, 202
+    return render_template("job.html", job_id=job_id), 202
 
-        media_items = list_all_media_items(service, session_id)
 
-        conn = sqlite3.connect(DB_NAME)
-        cursor = conn.cursor()
-        sequence = 0
+@app.route("/jobs/<int:job_id>", methods=["GET"])
+def job_status(job_id):
+    job = db.get_job(db.connect(DB_NAME), job_id)
+    if job is None:
+        return {"error": "Unknown job"}, 404
+    return job
 
-        for media_item in media_items:
-            file_name = media_item["mediaFile"]["filename"]
-            file_path = os.path.join(IMAGE_FOLDER, file_name)
 
-            # Check if the file already exists in the database
-            cursor.execute("SELECT COUNT(*) FROM images WHERE path = ?", (file_path,))
-            if cursor.fetchone()[0] > 0:
-                # If the file exists, skip downloading it
-                print(f"File {file_name} already exists in the database. Skipping download.")
+@app.route("/jobs/<int:job_id>/events", methods=["GET"])
+def job_events(job_id):
+    """
+    Server-sent events: the job status whenever it changes, until it ends.
+    """
+    def stream():
+        conn = db.connect(DB_NAME)
+        last = None
+        while True:
+            job = db.get_job(conn, job_id)
+            if job is None:
+                yield "event: error\ndata: Unknown job\n\n"
+                return
+            # The rates are recomputed from the clock on every read, so
+            # only the stored columns decide whether anything happened
+            state = [job[name] for name in ("state", "error") + db.JOB_COUNTERS]
+            if state != last:
+                yield f"data: {json.dumps(job)}\n\n"
+                last = state
+            if job["state"] in (db.JOB_DONE, db.JOB_FAILED):
+                return
+            time.sleep(JOB_EVENT_INTERVAL)
+
+    return Response(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+def ingest_session(session_id, progress):
+    """
+    Job handler: download, transcode and record everything picked in a
+    Picker session.
+
+    Paging, downloading, transcoding (on every core) and recording overlap:
+    the first photos are in the library and on the panel while later pages
+    are still being listed.
+    """
+    conn = db.connect(DB_NAME)
+    frames = FrameStore(FRAME_STORE)
+
+    def downloaded(results):
+        for media_item, result, error in results:
+            if error is not None:
+                print(f"Failed to download {media_item['mediaFile']['filename']}: {error}")
+                progress.add(failed=1)
                 continue
-            
-            # If the file doesn't exist, download and store it
-            download_media_item(media_item, token)
+            content_hash, file_path = result
+            progress.add(downloaded=1, bytes=os.path.getsize(file_path))
+            preview_path = image_store.path_for(content_hash, ".preview.png")
+            yield (media_item["id"], content_hash), file_path, preview_path
+
+    def rendered_twin(item):
+        # Identical originals reuse the frame and metadata already made for them
+        (_, content_hash), _, _ = item
+        for image_id, metadata in db.images_with_hash(conn, content_hash):
+            frame = frames.get(image_id)
+            if frame is not None:
+                return frame, metadata
+        return None
 
-            cursor.execute(
-                "INSERT INTO images (path, sequence) VALUES (?, ?)",
-                (file_path, sequence),
+    pending = iter_new_media_items(conn, iter_media_items(service, session_id), progress)
+    batch = []
+    flushed = None  # the first photo is recorded as soon as it lands
+    started = time.monotonic()
+    try:
+        with downloads.make_client(get_auth_token, DOWNLOAD_CONCURRENCY) as client, \
+                transcode.pool(TRANSCODE_WORKERS) as executor:
+            results = downloads.download_all(
+                pending, lambda item: download_media_item(client, item), DOWNLOAD_CONCURRENCY
+            )
+            # Lazily chained, so downloads only run ahead of the workers by a few photos
+            transcoded = transcode.transcode_all(
+                executor, TRANSCODE_WORKERS, downloaded(results), DITHER, cached=rendered_twin
             )
-            sequence += 1
+            for item, result, error in transcoded:
+                if error is not None:
+                    print(f"Failed to transcode {item[1]}: {error}")
+                    progress.add(failed=1)
+                    discard_download(conn, item, batch)
+                    continue
+                batch.append((item, result))
+                progress.add(rendered=1)
+
+                # Small, frequent batches so photos show up while the rest download
+                if (
+                    flushed is None
+                    or len(batch) >= INGEST_BATCH
+                    or time.monotonic() - flushed >= INGEST_FLUSH_INTERVAL
+                ):
+                    add_to_library(conn, frames, batch)
+                    batch = []
+                    flushed = time.monotonic()
+        add_to_library(conn, frames, batch)
+    finally:
+        frames.close()
 
-        conn.commit()
-        conn.close()
-        
-        return redirect("/picker")
-    except Exception as e:
-        print(f"Error during image processing: {e}")
-        return render_template(
-            "error.html", error_message="Failed to download or store images."
+    rendered = progress.counters["rendered"]
+    elapsed = time.monotonic() - started
+    print(f"Imported {rendered} images in {elapsed:.1f}s ({rendered / elapsed:.2f} images/sec).")
+
+
+def discard_download(conn, item, batch):
+    """
+    Remove a download that could not be transcoded from the image store,
+    unless the library (or the batch about to be recorded) uses the same
+    bytes; otherwise nothing would ever point at it.
+    """
+    (_, content_hash), file_path, preview_path = item
+    if db.images_with_hash(conn, content_hash) or any(
+        pending[0][1] == content_hash for pending, _ in batch
+    ):
+        return
+    for path in (file_path, preview_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def add_to_library(conn, frames, batch):
+    """
+    Record a batch of transcoded downloads, with their panel buffers and
+    metadata, in one short transaction.
+    """
+    if not batch:
+        return
+    with db.transaction(conn) as cursor:
+        added = db.add_images(
+            cursor,
+            [(media_id, file_path, content_hash) for ((media_id, content_hash), file_path, _), _ in batch],
         )
+        metadata = []
+        for ((media_id, _), _, _), (frame, image_metadata) in batch:
+            if media_id in added:
+                # Written before commit, so playback never finds a row without its frame
+                frames.put(added[media_id], frame)
+                metadata.append((added[media_id], image_metadata))
+        db.set_image_metadata(cursor, metadata)
 
 
 @app.route("/kill", methods=["GET"])
 def kill():
     os.system("pkill -f ngrok")
 
-    os.remove(DB_NAME)
-    for file in os.listdir("images"):
-        os.remove(os.path.join("images", file))
-    os.rmdir("images")
+    # Nothing may still be using the DB (or its -wal/-shm files) once it is
+    # gone.  An import in progress is dropped along with the jobs table.
+    stop_watching.set()
+    job_worker.stop(KILL_TIMEOUT)
+    with session_lock:
+        watchers = list(session_watchers)
+    # Any poller started after this sees stop_watching and exits at once
+    for watcher in watchers:
+        watcher.join(KILL_TIMEOUT)
+    db.close_all(DB_NAME)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(DB_NAME + suffix):
+            os.remove(DB_NAME + suffix)
+    if os.path.exists(FRAME_STORE):
+        os.remove(FRAME_STORE)
+    shutil.rmtree(IMAGE_FOLDER, ignore_errors=True)
     
     return "Server killed."
 
@@ -164,13 +302,95 @@ def create_session(service):
     return response["id"], response["expireTime"], response["pickerUri"]
 
 
-def get_auth_token(token_file):
-    with open(token_file, "r") as token:
-        return json.load(token)["token"]
+def get_session(service, session_id):
+    return service.sessions().get(sessionId=session_id).execute()
+
 
+def parse_timestamp(value):
+    # RFC 3339 as returned by the API, e.g. 2025-01-01T12:00:00.123456789Z.
+    # Before Python 3.11 fromisoformat takes no "Z" and only 3 or 6
+    # fractional digits, so normalise the fraction to microseconds
+    value = value.replace("Z", "+00:00")
+    match = re.match(r"(.*T[\d:]+)(?:\.(\d+))?(.*)$", value)
+    if match:
+        whole, fraction, offset = match.groups()
+        value = f"{whole}.{(fraction or '').ljust(6, '0')[:6]}{offset}"
+    return datetime.fromisoformat(value).timestamp()
 
-def list_all_media_items(service, session_id, page_size=100):
-    media_items = []
+
+def parse_duration(value, default):
+    # Protobuf Duration JSON, e.g. "5s" or "3.5s"
+    try:
+        return float(value.rstrip("s"))
+    except (AttributeError, ValueError):
+        return default
+
+
+def current_picker_uri():
+    """
+    Picker URI of the current session, creating a new session only when
+    the last one has expired or its selection has already been imported.
+    """
+    global session_id, expire_time, picker_uri
+    with session_lock:
+        reusable = (
+            session_id is not None
+            and parse_timestamp(expire_time) - time.time() > SESSION_EXPIRY_MARGIN
+            and db.find_job(db.connect(DB_NAME), session_id) is None
+        )
+        if not reusable:
+            session_id, expire_time, picker_uri = create_session(service)
+            watcher = threading.Thread(
+                target=watch_session, args=(session_id, expire_time), name="picker-poll", daemon=True
+            )
+            watcher.start()
+            session_watchers[:] = [thread for thread in session_watchers if thread.is_alive()] + [watcher]
+        return picker_uri
+
+
+def watch_session(session_id, expire_time):
+    """
+    Poll a Picker session at the interval the API asks for and queue its
+    import as soon as the user finishes picking.
+    """
+    deadline = parse_timestamp(expire_time)
+    conn = db.connect(DB_NAME)
+    while time.time() < deadline and not stop_watching.is_set():
+        if db.find_job(conn, session_id) is not None:
+            return  # confirmed by hand (failed jobs do not count)
+        try:
+            session = get_session(service, session_id)
+        except Exception as e:
+            print(f"Failed to poll picker session: {e}")
+            session = {}
+        if session.get("mediaItemsSet"):
+            job_id = job_worker.submit(session_id)
+            print(f"Selection complete, started import job {job_id}.")
+            return
+        polling = session.get("pollingConfig", {})
+        timeout = parse_duration(polling.get("timeoutIn"), None)
+        if timeout is not None:
+            deadline = min(deadline, time.time() + timeout)
+        stop_watching.wait(parse_duration(polling.get("pollInterval"), SESSION_POLL_INTERVAL))
+
+
+def get_auth_token():
+    """
+    Current access token from the credentials the Picker service uses,
+    refreshed in-process before it expires.
+    """
+    from google_apis import access_token, get_credentials
+
+    creds = get_credentials(client_file, *PICKER_API, PICKER_SCOPES, host_ip=service_host_ip, interactive=False)
+    if creds is None:
+        raise RuntimeError("Not signed in to Google Photos; restart the server to sign in again.")
+    return access_token(creds)
+
+
+def iter_media_items(service, session_id, page_size=100):
+    """
+    Yield the picked media items page by page as the API returns them.
+    """
     next_page_token = None
     while True:
         response = (
@@ -178,131 +398,115 @@ def list_all_media_items(service, session_id, page_size=100):
             .list(sessionId=session_id, pageSize=page_size, pageToken=next_page_token)
             .execute()
         )
-        media_items.extend(response.get("mediaItems", []))
+        yield from response.get("mediaItems", [])
         next_page_token = response.get("nextPageToken")
         if not next_page_token:
             break
-    return media_items
 
 
-def download_media_item(media_item, token):
+def iter_new_media_items(conn, media_items, progress, chunk_size=100):
+    """
+    Filter a stream of media items down to those not in the library yet,
+    checking the DB one chunk at a time.
+    """
+    seen = set()
+    media_items = iter(media_items)
+    while True:
+        chunk = list(itertools.islice(media_items, chunk_size))
+        if not chunk:
+            return
+        progress.add(listed=len(chunk))
+        known = db.known_media_ids(conn, [item["id"] for item in chunk])
+        for media_item in chunk:
+            if media_item["id"] not in known and media_item["id"] not in seen:
+                seen.add(media_item["id"])
+                yield media_item
+
+
+def media_download_url(media_item):
+    """
+    URL and file extension to download for a media item: the original when
+    archiving, otherwise a JPEG rendition just big enough for the panel.
+    """
     base_url = media_item["mediaFile"]["baseUrl"]
-    file_name = media_item["mediaFile"]["filename"]
-    download_url = f"{base_url}=d"
+    if ARCHIVE_ORIGINALS:
+        extension = os.path.splitext(media_item["mediaFile"]["filename"])[1].lower() or ".jpg"
+        return f"{base_url}=d", extension
 
-    media_response = httpx.get(
-        download_url, headers={"Authorization": f"Bearer {token}"}
-    )
-    file_path = os.path.join(IMAGE_FOLDER, file_name)
+    from render import rendition_size
 
-    with open(file_path, "wb") as file:
-        file.write(media_response.content)
+    # The service scales to fit inside w x h, keeping the aspect ratio
+    width, height = rendition_size(RENDITION_OVERSAMPLE)
+    return f"{base_url}=w{width}-h{height}", ".jpg"
 
-    return file_name
 
-def fetch_next_image():
+def download_media_item(client, media_item):
     """
-    Fetch the next image based on playback mode.
+    Stream a media item into the image store; returns (sha256, path).
+
+    Only returns once the file is complete and durable, so the caller can
+    record it in the DB; a failed transfer resumes on the next confirm.
     """
-    with sqlite3.connect(DB_NAME) as conn:
-        cursor = conn.cursor()
-        if PLAYBACK_MODE == 'sequential':
-            # Get the last shown image
-            cursor.execute("SELECT id, path FROM images WHERE last_shown = 1 ORDER BY sequence LIMIT 1")
-            last_shown = cursor.fetchone()
-
-            # Select the next image in sequence
-            if last_shown:
-                cursor.execute("UPDATE images SET last_shown = 0 WHERE id = ?", (last_shown[0],))
-                cursor.execute(
-                    """
-                    SELECT id, path FROM images 
-                    WHERE sequence > (SELECT sequence FROM images WHERE id = ?) 
-                    ORDER BY sequence LIMIT 1
-                    """,
-                    (last_shown[0],)
-                )
-            else:
-                cursor.execute("SELECT id, path FROM images ORDER BY sequence LIMIT 1")
-
-        elif PLAYBACK_MODE == 'random':
-            # Random playback mode
-            cursor.execute("SELECT id, path FROM images ORDER BY RANDOM() LIMIT 1")
-        else:
-            logging.warning("Invalid playback mode. Defaulting to sequential.")
-            cursor.execute("SELECT id, path FROM images ORDER BY sequence LIMIT 1")
-
-        image = cursor.fetchone()
-
-        # Update the last_shown flag
-        if image:
-            cursor.execute("UPDATE images SET last_shown = 1 WHERE id = ?", (image[0],))
-            return image[1]  # Return full path to the image
-        return None
+    download_url, extension = media_download_url(media_item)
+
+    # Keyed by item and size so a resumed transfer continues the same bytes
+    part_path = image_store.partial_path(f"{media_item['id']}_{download_url.rsplit('=', 1)[1]}")
+    content_hash, _ = downloads.fetch_to_file(client, download_url, part_path)
+    try:
+        check_decodes(part_path)
+    except Exception:
+        # Truncated or not an image: never store it under this hash
+        os.remove(part_path)
+        raise
+    return content_hash, image_store.adopt(part_path, content_hash, extension)
 
 
-def render_image(epd, image_path):
+def check_decodes(path):
     """
-    Render the given image on the e-paper display.
+    Raise unless path holds a complete image.  The sha256 only names the
+    bytes we got, and a body sent without a length can end early unnoticed;
+    Image.verify() does not catch a truncated JPEG, so decode it, scaled
+    down to panel size where the format allows.
     """
-    if not os.path.exists(image_path):
-        logging.error(f"Image not found: {image_path}")
-        return
-
-    # Prepare the image for display
-    image = Image.open(image_path).convert('1')
-    image.thumbnail((epd.height, epd.width), Image.LANCZOS)
-
-    # Center the image on the display
-    canvas = Image.new('1', (epd.height, epd.width), 255)
-    x_offset = (epd.height - image.width) // 2
-    y_offset = (epd.width - image.height) // 2
-    canvas.paste(image, (x_offset, y_offset))
+    from PIL import Image
+    from render import rendition_size
 
-    # Display the image
-    epd.init(epd.FULL_UPDATE)
-    epd.display(epd.getbuffer(canvas))
-    time.sleep(2)  # Hold the image for stability
-    epd.sleep()
-    logging.info(f"Image rendered: {image_path}")
+    with Image.open(path) as image:
+        image.draft("L", rendition_size(1))
+        image.load()
 
+def display_QR(image):
+    from display_driver import display_frame, open_panel
+    from render import render_frame
 
-def display_QR(image: Image):
     logging.info("Displaying QR code...")
-    epd = epd2in13_V2.EPD()
-    render_image(epd, image)
-    
-    
+    epd = open_panel()
+    display_frame(epd, render_frame(image, DITHER))
 
-def start_display_driver():
-    """
-    Main function to start the display driver.
-    """
-    try:
-        logging.info("Initializing E-Paper display driver...")
-        epd = epd2in13_V2.EPD()
-        while True:
-            image_path = fetch_next_image()
-            if image_path:
-                render_image(epd, image_path)
-            else:
-                logging.warning("No images available.")
-            time.sleep(REFRESH_RATE)
-    except KeyboardInterrupt:
-        logging.info("Display driver interrupted.")
-    except Exception as e:
-        logging.error(f"Unexpected error: {e}")
-    finally:
-        logging.info("Shutting down the display driver.")
 
 service = None
+service_host_ip = None  # for device-flow sign-in, as given to init_service
+
+def init_storage():
+    global image_store, job_worker
+    db.init_db(DB_NAME)
+    image_store = ImageStore(IMAGE_FOLDER)
+    job_worker = JobWorker(DB_NAME, ingest_session)
 
 def init_service(host_ip=None):
-    global service
+    global service, service_host_ip
+    service_host_ip = host_ip
     service = create_photos_picker_service(client_file, host_ip=host_ip)
 
 if __name__ == "__main__":
+    if "--import-time" in sys.argv:
+        from startup import import_time_report
+        sys.exit(import_time_report("server"))
+
+    from pyngrok import ngrok
+
     os.system("pkill -f ngrok")
+    init_storage()
 
     public_url = ngrok.connect(5000)
     url = public_url.public_url
@@ -311,5 +515,11 @@ if __name__ == "__main__":
     hostname = url.split("//")[1].split(":")[0]
     ip_address = socket.gethostbyname(hostname)
     init_service(host_ip=ip_address)
+
+    debug = True
+    # The debug reloader runs this block in a watcher process as well; only
+    # the serving process works through the job queue
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        job_worker.start()
     
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    app.run(host="0.0.0.0", port=5000, debug=debug)
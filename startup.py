@@ -0,0 +1,42 @@
+import os
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def import_time_report(module, top=15):
+    """
+    Import `module` in a fresh interpreter with `-X importtime` and print
+    the cold-start cost: total wall time and the heaviest imports.
+    """
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=REPO_DIR,
+        capture_output=True,
+        text=True,
+    )
+    wall_ms = (time.perf_counter() - start) * 1000
+
+    # Lines look like: "import time:   self [us] | cumulative | imported package"
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, self_us, cumulative_us, name = [part.strip() for part in line.replace("import time:", "|", 1).split("|")]
+        imports.append((int(cumulative_us), int(self_us), name))
+
+    if result.returncode != 0:
+        print(result.stderr.splitlines()[-1] if result.stderr else f"import {module} failed")
+        return result.returncode
+
+    total_ms = next((c for c, _, n in imports if n.strip() == module), 0) / 1000
+    print(f"Startup report for '{module}'")
+    print(f"  interpreter + import wall time: {wall_ms:8.1f} ms")
+    print(f"  import {module}:{' ' * max(1, 24 - len(module))}{total_ms:8.1f} ms")
+    print(f"  heaviest imports (cumulative):")
+    for cumulative_us, self_us, name in sorted(imports, reverse=True)[:top]:
+        print(f"    {cumulative_us / 1000:8.1f} ms  {name.strip()}")
+    return 0
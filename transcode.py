@@ -0,0 +1,71 @@
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from pipeline import bounded_ordered_map
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+def pool(workers=None):
+    """
+    Process pool for transcoding, one worker per core by default.
+
+    Workers are started from a clean forkserver process rather than forked
+    from the ingest server, whose download threads must not be copied.
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers or default_workers(),
+        mp_context=multiprocessing.get_context('forkserver'),
+    )
+
+
+def transcode(path, dither, preview_path=None):
+    """
+    Worker: decode -> orient -> resize -> dither -> pack one photo.
+
+    Saves the dithered canvas as a PNG preview (unless one exists) and
+    returns (panel buffer bytes, metadata dict).
+    """
+    from PIL import ExifTags, Image
+    import render
+    from lib import framebuffer
+    from lib.epd2in13_V2 import EPD_WIDTH, EPD_HEIGHT
+
+    with Image.open(path) as image:
+        width, height = render.oriented_size(image)
+        exif = image.getexif()
+        taken = exif.get_ifd(ExifTags.IFD.Exif).get(ExifTags.Base.DateTimeOriginal) or exif.get(ExifTags.Base.DateTime)
+        canvas = render.prepare_image(image, dither)
+    frame = framebuffer.pack(canvas, EPD_WIDTH, EPD_HEIGHT)
+
+    if preview_path and not os.path.exists(preview_path):
+        tmp_path = f"{preview_path}.{os.getpid()}.tmp"
+        canvas.save(tmp_path, 'PNG', optimize=True)
+        os.replace(tmp_path, preview_path)
+
+    metadata = {'width': width, 'height': height, 'taken': taken, 'preview': preview_path}
+    return frame, metadata
+
+
+def transcode_all(executor, workers, items, dither, cached=None):
+    """
+    Transcode (key, path, preview_path) items on an executor from pool().
+
+    `items` is pulled lazily and at most two jobs per worker are queued, so
+    a faster producer (the downloads) is held back instead of piling up
+    files. `cached(item)`, if given, may return a ready (frame, metadata)
+    to skip the work. Yields (item, result, error) in the order of `items`;
+    exactly one of result and error is None.
+    """
+    def submit(item):
+        result = cached(item) if cached else None
+        if result is None:
+            _, path, preview_path = item
+            return executor.submit(transcode, path, dither, preview_path)
+        future = Future()
+        future.set_result(result)
+        return future
+
+    return bounded_ordered_map(submit, items, 2 * workers)